@@ -1,5 +1,4 @@
 import json
-import mmh3
 import logging
 import sys
 import socket
@@ -12,7 +11,7 @@ from prompt_toolkit.validation import Validator, ValidationError
 from prompt_toolkit.history import InMemoryHistory, FileHistory
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 
-from cassandra.util.message import RequestMessage, ResponseMessage
+from cassandra.util.message import RequestMessage, ResponseMessage, hash_request, pack_request
 from cassandra.util.message_codes import MESSAGE_CODE_RESPONSE
 from cassandra.util.packing import recv_msg, addr_tuple_to_str, addr_str_to_tuple
 
@@ -39,7 +38,7 @@ class CassandraClient():
         self.addr = ''
         self.socket = None
 
-        self.commands = ['put', 'get', 'connect', 'disconnect', 'exit', 'set', 'batchput', 'batchget']
+        self.commands = ['put', 'get', 'connect', 'disconnect', 'exit', 'set', 'batchput', 'batchget', 'stats']
 
     def start(self):
         
@@ -55,7 +54,8 @@ class CassandraClient():
             'exit': self.handle_exit,
             'set': self.handle_set,
             'batchput': self.handle_batchput,
-            'batchget': self.handle_batchget
+            'batchget': self.handle_batchget,
+            'stats': self.handle_stats
         }
 
         while True:
@@ -122,6 +122,10 @@ class CassandraClient():
             return ['get', parts[1]]
         elif cmdType == 'set':
             pass
+        elif cmdType == 'stats':
+            if not len(parts) == 1:
+                raise ValidationError(message='Invalid grammar for %s' % cmdType)
+            return ['stats']
         elif cmdType == 'batchput':
             if not (len(parts) == 2):
                 raise ValidationError(message='Invalid grammar for %s' % cmdType)
@@ -188,7 +192,8 @@ class CassandraClient():
             logging.error('Client | socket not connected')
             return
         key = cmd[1]
-        value = cmd[2]
+        # values are stored as bytes, text typed in is sent utf-8 encoded
+        value = cmd[2] if isinstance(cmd[2], bytes) else bytes(cmd[2], 'utf-8')
         self.send_request(['put', key, value])
         msg = self.get_response()
         print(msg.description, file=file)
@@ -200,7 +205,22 @@ class CassandraClient():
         key = cmd[1]
         self.send_request(['get', key])
         msg = self.get_response()
-        print(msg.description, file=file)
+        print(self.format_row(msg.description), file=file)
+
+    @staticmethod
+    def format_row(description):
+        # [value, version] of a get, the value bytes are only decoded for display
+        if isinstance(description, list) and description and isinstance(description[0], bytes):
+            return [description[0].decode('utf-8', 'backslashreplace')] + description[1:]
+        return description
+
+    def handle_stats(self, cmd):
+        if not self.check_connect(True):
+            logging.error('Client | socket not connected')
+            return
+        self.send_request(['stats'])
+        msg = self.get_response()
+        print(json.dumps(msg.description, indent=2, sort_keys=True))
 
     def handle_set(self, cmd):
         pass
@@ -244,10 +264,8 @@ class CassandraClient():
         print('time: %fs' % (end - start))
 
     def send_request(self, request):
-        request_hash = mmh3.hash(json.dumps((self.addr, tuple(request))))
-        d = {'request': request, 'request_hash': request_hash}
-        s = bytes(json.dumps(d), 'ascii')
-        message = RequestMessage(s, self.addr)
+        request_hash = hash_request(self.addr, request)
+        message = RequestMessage(pack_request(request, request_hash), self.addr)
         try:
             self.socket.send(message.encode())
         except Exception as e:
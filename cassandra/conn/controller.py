@@ -19,23 +19,43 @@ class Controller(Process):
         self.listen_addr = listen_addr
         self.registrations = {}
         self.queues = {}
+        self.routers = {}
 
-    def register(self, register_code, register_identifier):
+    def register(self, register_code, register_identifier, router=None):
+        """Subscribe register_identifier to the messages of register_code, returns its queue.
+
+        router(message) may return the identifier of another queue (see get_queue) that gets a message instead of
+        the queue of register_identifier, e.g. the queue of the storage shard owning its key; None keeps it.
+        Registrations have to be made before the controller is started.
+        """
         if register_code not in self.registrations:
             self.registrations[register_code] = []
         if register_identifier not in self.registrations[register_code]:
             self.registrations[register_code].append(register_identifier)
-        if register_identifier not in self.queues:
-            self.queues[register_identifier] = Queue()
+        if router is not None:
+            self.routers[register_identifier] = router
 
         logging.debug('%s registered %s for code %d' % (self.label, register_identifier, register_code))
-        return self.queues[register_identifier]
+        return self.get_queue(register_identifier)
+
+    def get_queue(self, identifier):
+        if identifier not in self.queues:
+            self.queues[identifier] = Queue()
+        return self.queues[identifier]
 
     def spread_message(self, msg_code, identifier, message):
         for register_identifier in self.registrations.get(msg_code, []):
-            self.queues[register_identifier].put({
+            target = register_identifier
+            router = self.routers.get(register_identifier)
+            if router is not None:
+                try:
+                    target = router(message) or register_identifier
+                except Exception as e:
+                    logging.error('%s | routing message %s for %s failed: %s'
+                                  % (self.label, message, register_identifier, e), exc_info=True)
+            self.queues[target].put({
                 'type': msg_code,
-                'identifier': register_identifier,
+                'identifier': target,
                 'remote_identifier': identifier,
                 'message': message})
 
@@ -60,15 +60,17 @@ class Node:
 
         sys.exit(exit_codes)
 
-    def register(self, identifier, code):
-
-        q = self.controller.register(code, identifier)
+    def register(self, identifier, code, router=None):
+        # router(message): identifier of the manager getting a message instead, see Controller.register
+        q = self.controller.register(code, identifier, router)
         if identifier not in self.queues:
             self.queues[identifier] = q
 
     def get_manager(self, identifier):
-
+        # managers of identifiers that did not register get the messages routed to them (see register)
         queue = self.queues.get(identifier, None)
+        if queue is None:
+            queue = self.queues[identifier] = self.controller.get_queue(identifier)
         manager = NodeManager(
             identifier,
             self.sender_queue,
@@ -119,9 +121,9 @@ class NodeManager:
             'message': msg
             })
 
-    def get_msg(self, block=True):
+    def get_msg(self, block=True, timeout=None):
         try:
-            return self.message_queue.get(block=block)
+            return self.message_queue.get(block=block, timeout=timeout)
         except Empty:
             return None
 
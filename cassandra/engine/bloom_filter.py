@@ -0,0 +1,69 @@
+import math
+import os
+import struct
+
+import mmh3
+
+from cassandra.util import fsync_file
+
+BLOOM_FILTER_FILE_EXT = '.ssbf'
+
+_HEADER = struct.Struct('>4sIQ')    # magic, number of hashes, number of bits
+_MAGIC = b'SSBF'
+
+
+class BloomFilter:
+    """Bloom filter of the keys of one SSTable.
+
+    Bit positions are derived from the two halves of a 128 bit murmur3 hash (double hashing).
+
+    Bloom filter file format (all integers are big-endian):
+        magic 'SSBF' (4s) | number of hashes (I) | number of bits (Q) | bit array
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(num_hashes, 1)
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_chance):
+        """Create a filter sized for capacity keys at the given false positive chance"""
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(fp_chance) / (math.log(2) ** 2)))
+        num_hashes = int(round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def positions(self, key):
+        h1, h2 = mmh3.hash64(key)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def might_contain(self, key):
+        for p in self.positions(key):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        return self.might_contain(key)
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, self.num_hashes, self.num_bits))
+            f.write(self.bits)
+            fsync_file(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            magic, num_hashes, num_bits = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError('%s is not a bloom filter file' % path)
+            return cls(num_bits, num_hashes, bytearray(f.read()))
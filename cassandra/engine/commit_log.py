@@ -0,0 +1,157 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+COMMIT_LOG_FILE_PREFIX = 'CommitLog-'
+COMMIT_LOG_FILE_EXT = '.log'
+
+SYNC_MODES = ['always', 'group', 'periodic']
+
+_RECORD_HEADER = struct.Struct('>II')   # payload length, crc32 of payload
+_PAYLOAD_HEADER = struct.Struct('>BHQ')  # payload format, key length, version
+PAYLOAD_FORMAT = 1
+
+
+def encode_record(key, value, version):
+    b_key = bytes(key, 'utf-8')
+    payload = _PAYLOAD_HEADER.pack(PAYLOAD_FORMAT, len(b_key), version) + b_key + value
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload):
+    """(key, value, version) of a record payload"""
+    _, key_length, version = _PAYLOAD_HEADER.unpack_from(payload)
+    key_end = _PAYLOAD_HEADER.size + key_length
+    return payload[_PAYLOAD_HEADER.size:key_end].decode('utf-8'), payload[key_end:], version
+
+
+class CommitLog:
+    """Append-only log of the writes accepted into the memtable, replayed on startup.
+
+    The log is a sequence of segment files (CommitLog-<id>.log), a new segment is started whenever the memtable is
+    flushed and segments are discarded once the SSTable holding their writes is written.
+
+    Record format: payload length (I) | crc32 of payload (I) | payload
+    Payload format: format (B, 1) | key length (H) | version (Q) | key (utf-8) | value (bytes)
+
+    Sync modes:
+        always:   every append is fsynced before it returns
+        group:    appends are fsynced together, at most group_window seconds after the first unsynced one. Callers
+                  acknowledge writes only after sync (see get_sync_delay)
+        periodic: a background thread (periodic_sync_task) fsyncs every sync_period seconds, writes are acknowledged
+                  right away
+    """
+
+    def __init__(self, log_dir, sync_mode='periodic', sync_period=1.0, group_window=0.01):
+        if sync_mode not in SYNC_MODES:
+            raise ValueError('Unknown commit log sync mode %s, expected one of %s' % (sync_mode, SYNC_MODES))
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        self.log_dir = log_dir
+        self.sync_mode = sync_mode
+        self.sync_period = sync_period
+        self.group_window = group_window
+
+        self.lock = threading.Lock()
+        self.unsynced_since = None
+        existing = self.get_segment_ids()
+        self.segment_id = existing[-1] + 1 if existing else 0
+        self.segment = open(self.get_segment_path(self.segment_id), 'ab')
+
+    def get_segment_path(self, segment_id):
+        return os.path.join(self.log_dir, '%s%d%s' % (COMMIT_LOG_FILE_PREFIX, segment_id, COMMIT_LOG_FILE_EXT))
+
+    def get_segment_ids(self):
+        ids = []
+        for f in os.listdir(self.log_dir):
+            if f.startswith(COMMIT_LOG_FILE_PREFIX) and f.endswith(COMMIT_LOG_FILE_EXT):
+                ids.append(int(f[len(COMMIT_LOG_FILE_PREFIX):-len(COMMIT_LOG_FILE_EXT)]))
+        return sorted(ids)
+
+    def append(self, key, value, version):
+        record = encode_record(key, value, version)
+        with self.lock:
+            self.segment.write(record)
+            if self.sync_mode == 'always':
+                self._sync()
+            elif self.unsynced_since is None:
+                self.unsynced_since = time.time()
+
+    def append_many(self, records):
+        """Append (key, value, version) records with a single write (and a single fsync in always mode)"""
+        data = b''.join(encode_record(*record) for record in records)
+        if not data:
+            return
+        with self.lock:
+            self.segment.write(data)
+            if self.sync_mode == 'always':
+                self._sync()
+            elif self.unsynced_since is None:
+                self.unsynced_since = time.time()
+
+    def _sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.unsynced_since = None
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced_since is not None:
+                self._sync()
+
+    def get_sync_delay(self):
+        """Seconds until the pending group of writes has to be synced, None if nothing is pending"""
+        unsynced_since = self.unsynced_since
+        if unsynced_since is None:
+            return None
+        return max(0.0, unsynced_since + self.group_window - time.time())
+
+    def roll(self):
+        """Start a new segment, returns the id of the finished one"""
+        with self.lock:
+            self._sync()
+            self.segment.close()
+            finished = self.segment_id
+            self.segment_id = self.segment_id + 1
+            self.segment = open(self.get_segment_path(self.segment_id), 'ab')
+            return finished
+
+    def discard(self, segment_id):
+        """Remove the segments up to segment_id, their writes are persisted in SSTables"""
+        for i in self.get_segment_ids():
+            if i <= segment_id and i != self.segment_id:
+                os.remove(self.get_segment_path(i))
+
+    def replay(self):
+        """Iterate (key, value, version) over the writes of the segments written before this log was opened"""
+        for i in self.get_segment_ids():
+            if i >= self.segment_id:
+                continue
+            with open(self.get_segment_path(i), 'rb') as segment:
+                while True:
+                    header = segment.read(_RECORD_HEADER.size)
+                    if len(header) == 0:
+                        break
+                    if len(header) < _RECORD_HEADER.size:
+                        logging.warning('CommitLog | Truncated record header at the end of segment %d' % i)
+                        break
+                    length, crc = _RECORD_HEADER.unpack(header)
+                    payload = segment.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        logging.warning('CommitLog | Torn record at the end of segment %d, ignoring it' % i)
+                        break
+                    yield decode_payload(payload)
+
+    def periodic_sync_task(self, stopped=None):
+        """fsync every sync_period seconds until stopped (a threading.Event) is set"""
+        stopped = stopped or threading.Event()
+        while not stopped.wait(self.sync_period):
+            try:
+                self.sync()
+            except Exception as e:
+                logging.error('CommitLog | Error occurred during periodic sync: %s' % e, exc_info=True)
@@ -0,0 +1,133 @@
+import heapq
+import itertools
+
+
+def _decorate(rows, i):
+    # rows of newer SSTables (greater i) sort first among rows with the same key and version
+    for key, version, data in rows:
+        yield key, -version, -i, data
+
+
+def merge_sstables(sstables):
+    """k-way merge by key of SSTable rows.
+
+    sstables: row iterators (yielding (key, version, data) in key order), oldest SSTable first
+    Yields (key, version, data) in key order, keeping only the highest version of each key (the row of the newest
+    SSTable on equal versions).
+    """
+    merged = heapq.merge(*[_decorate(rows, i) for i, rows in enumerate(sstables)])
+    for key, group in itertools.groupby(merged, key=lambda row: row[0]):
+        _, version, _, data = next(group)
+        yield key, -version, data
+
+
+class SizeTieredCompactionStrategy:
+    """Size-tiered compaction: merge SSTables of similar size.
+
+    SSTables are sorted by size and grouped into buckets: an SSTable whose size is between bucket_low and bucket_high
+    times the average size of the current bucket joins it, otherwise it starts the next one. The bucket with the
+    smallest average size that has at least min_threshold SSTables is compacted (its max_threshold smallest SSTables).
+    The inputs need not be adjacent in the SSTable order: the output takes the place of the newest input, and
+    DataStorage.compact leaves out the rows of the inputs that SSTables between them hold newer versions of.
+    """
+
+    def __init__(self, config, sstable_size):
+        # output is never split
+        self.max_sstable_size = None
+        self.min_threshold = int(config.get('compaction_min_threshold', 4))
+        self.max_threshold = int(config.get('compaction_max_threshold', 32))
+        self.bucket_low = float(config.get('compaction_bucket_low', 0.5))
+        self.bucket_high = float(config.get('compaction_bucket_high', 1.5))
+
+    def get_buckets(self, sstables):
+        """Buckets of (name, size) of similar size, each sorted by size"""
+        buckets = []
+        bucket = []
+        total = 0
+        for name, size in sorted(((name, metadata['size']) for name, metadata in sstables), key=lambda t: t[1]):
+            if bucket:
+                average = total / len(bucket)
+                if self.bucket_low * average <= size <= self.bucket_high * average:
+                    bucket.append((name, size))
+                    total = total + size
+                    continue
+                buckets.append(bucket)
+            bucket = [(name, size)]
+            total = size
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    def get_next_compaction(self, sstables):
+        """sstables: list of (name, metadata), oldest first.
+
+        Returns (names of the SSTables to merge, oldest first, level of the output), or None
+        """
+        candidates = [b for b in self.get_buckets(sstables) if len(b) >= self.min_threshold]
+        if not candidates:
+            return None
+        bucket = min(candidates, key=lambda b: sum(size for _, size in b) / len(b))
+        selected = set(name for name, _ in bucket[:self.max_threshold])
+        inputs = [name for name, _ in sstables if name in selected]
+        return inputs, dict(sstables)[inputs[-1]]['level']
+
+
+class LeveledCompactionStrategy:
+    """Leveled compaction: SSTables of level 1 and above never overlap within their level.
+
+    Flushed SSTables land in level 0. Once level 0 has min_threshold SSTables, all of them are merged with the
+    overlapping SSTables of level 1. Level n >= 1 may hold sstable_size * fanout ** n bytes, when it holds more one of
+    its SSTables (round robin over the key space) is merged with the overlapping SSTables of level n + 1. The output is
+    split into SSTables of about sstable_size bytes, so a read consults every level 0 SSTable but at most one SSTable of
+    each other level.
+    """
+
+    def __init__(self, config, sstable_size):
+        self.max_sstable_size = sstable_size
+        self.min_threshold = int(config.get('compaction_min_threshold', 4))
+        self.fanout = int(config.get('leveled_fanout', 10))
+        # per level: max key of the SSTable compacted last
+        self.compaction_pointers = {}
+
+    @staticmethod
+    def get_overlapping(sstables, min_key, max_key):
+        return [(name, metadata) for name, metadata in sstables
+                if metadata['entries'] and metadata['min_key'] <= max_key and metadata['max_key'] >= min_key]
+
+    def get_next_compaction(self, sstables):
+        """sstables: list of (name, metadata), oldest first.
+
+        Returns (names of the SSTables to merge, oldest first, level of the output), or None
+        """
+        levels = {}
+        for name, metadata in sstables:
+            levels.setdefault(metadata['level'], []).append((name, metadata))
+
+        level0 = levels.get(0, [])
+        if len(level0) >= self.min_threshold:
+            ranges = [metadata for _, metadata in level0 if metadata['entries']]
+            inputs = level0
+            if ranges:
+                min_key = min(metadata['min_key'] for metadata in ranges)
+                max_key = max(metadata['max_key'] for metadata in ranges)
+                inputs = self.get_overlapping(levels.get(1, []), min_key, max_key) + level0
+            return [name for name, _ in inputs], 1
+
+        for level in sorted(level for level in levels if level > 0):
+            tables = sorted([t for t in levels[level] if t[1]['entries']], key=lambda t: t[1]['min_key'])
+            if not tables or sum(m['size'] for _, m in tables) <= self.max_sstable_size * self.fanout ** level:
+                continue
+            pointer = self.compaction_pointers.get(level)
+            candidates = [t for t in tables if pointer is None or t[1]['min_key'] > pointer]
+            name, metadata = (candidates or tables)[0]
+            self.compaction_pointers[level] = metadata['max_key']
+            overlapping = self.get_overlapping(levels.get(level + 1, []), metadata['min_key'], metadata['max_key'])
+            return [n for n, _ in overlapping] + [name], level + 1
+
+        return None
+
+
+COMPACTION_STRATEGIES = {
+    'size_tiered': SizeTieredCompactionStrategy,
+    'leveled': LeveledCompactionStrategy,
+}
@@ -0,0 +1,152 @@
+import heapq
+import logging
+import os
+from multiprocessing import Process, Queue, RawArray
+
+import mmh3
+
+from cassandra.engine.storage import DataStorage
+from cassandra.util.message import ResponseMessage, pack_response
+from cassandra.util.message_codes import MESSAGE_CODE_REQUEST
+from cassandra.util.packing import addr_tuple_to_str
+
+
+def create_storage(node, config):
+    """DataStorage of the node, or a StorageDispatcher in front of storage_shards DataStorage shards"""
+    if int(config.get('storage_shards', 1)) > 1:
+        return StorageDispatcher(node, config)
+    return DataStorage(node, config)
+
+
+KEY_REQUESTS = ('put', 'get', 'update')
+
+
+def get_shard(key, shard_num):
+    return mmh3.hash(key) % shard_num
+
+
+class ShardRouter:
+    """Router of the requests of a node (see Controller.register): the label of the shard owning the key of a put, get
+    or update request, None for the other requests, which go to the dispatcher"""
+
+    def __init__(self, shard_labels):
+        self.shard_labels = shard_labels
+
+    def __call__(self, message):
+        request = message.request
+        if request[0] in KEY_REQUESTS and len(request) > 1:
+            return self.shard_labels[get_shard(request[1], len(self.shard_labels))]
+        return None
+
+
+class StorageDispatcher(Process):
+    """Dispatcher of the requests of a node to storage_shards DataStorage processes.
+
+    Every shard owns the keys whose murmur3 hash modulo the number of shards is its number, and has its own memtable,
+    commit log and data directory (<datafile_dir>/shard-<n>). The controller of the node passes put, get and update
+    requests straight to the queue of the shard of their key (see ShardRouter), which answers them: they are decoded
+    once, by the receiver, and never go through the dispatcher. scan and stats requests come to the dispatcher, which
+    sends them to every shard and answers them: scan pages of the shards are merged by key, stats are returned per
+    shard. The memtable memory budget (memtable_memory_budget) is shared by all shards.
+
+    Keys are not moved when storage_shards changes, a data directory has to be used with the same number of shards.
+    """
+
+    def __init__(self, node, config):
+        super(StorageDispatcher, self).__init__()
+
+        self.label = "DataStorage"
+
+        # configurations
+        self.shard_num = int(config.get('storage_shards', 1))
+        self.max_scan_page_size = int(config.get('max_scan_page_size', 32768))
+        datafile_dir = config.get('datafile_dir', 'data/')
+        commit_log_dir = config.get('commit_log_dir')
+
+        shard_labels = ['%s(Shard %d)' % (self.label, i) for i in range(self.shard_num)]
+        node.register(self.label, MESSAGE_CODE_REQUEST, ShardRouter(shard_labels))
+        self.manager = node.get_manager(self.label)
+
+        # accounted memtable memory of every shard, for the memtable_memory_budget of the node
+        self.memory_usage = RawArray('q', self.shard_num)
+        self.shard_queues = []
+        self.reply_queues = []
+        self.shards = []
+        for i, label in enumerate(shard_labels):
+            shard_config = dict(config, datafile_dir=os.path.join(datafile_dir, 'shard-%d' % i))
+            if commit_log_dir is not None:
+                shard_config['commit_log_dir'] = os.path.join(commit_log_dir, 'shard-%d' % i)
+            manager = node.get_manager(label)
+            self.shard_queues.append(manager.message_queue)
+            self.reply_queues.append(Queue())
+            self.shards.append(DataStorage(None, shard_config, manager=manager, label=label,
+                                           reply_queue=self.reply_queues[i], memory_usage=self.memory_usage, shard=i))
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+        super(StorageDispatcher, self).start()
+
+    def gather(self, msg):
+        """Send the request of msg to every shard, returns their (status, description) in shard order"""
+        for shard_queue in self.shard_queues:
+            shard_queue.put(dict(msg, gather=True))
+        return [reply_queue.get() for reply_queue in self.reply_queues]
+
+    def scan(self, msg, request):
+        limit = request[3] if len(request) > 3 else None
+        results = self.gather(msg)
+        for status, description in results:
+            if not status:
+                return status, description
+        return True, self.merge_scan_pages([description for _, description in results], limit)
+
+    def merge_scan_pages(self, pages, limit):
+        """Merge the pages of one scan from all shards into one page"""
+        # beyond the end of its page the rows of a shard are not known yet, the merged page stops at the first end
+        ends = [page['page_token'] for page in pages if page['page_token'] is not None]
+        end = min(ends) if ends else None
+
+        rows = []
+        page_size = 0
+        next_key = end
+        for row in heapq.merge(*[page['rows'] for page in pages]):
+            if end is not None and row[0] >= end:
+                break
+            row_size = DataStorage.get_scan_row_size(row)
+            if rows and (page_size + row_size > self.max_scan_page_size or (limit and len(rows) >= limit)):
+                next_key = row[0]
+                break
+            rows.append(row)
+            page_size = page_size + row_size
+        return {'rows': rows, 'page_token': next_key}
+
+    def run(self):
+        logging.info('%s started - Pid: %ds, %d shards' % (self.label, self.pid, self.shard_num))
+        while True:
+            msg = self.manager.get_msg()
+            values = msg['message'].get_values()
+            if values['code'] != MESSAGE_CODE_REQUEST:
+                logging.error('%s | Unsupported message type %s in message %s'
+                              % (self.label, values['code'], str(values)))
+                continue
+
+            request = values['request']
+            if request[0] in KEY_REQUESTS and len(request) > 1:
+                # routed here only if the controller could not route it (see ShardRouter), e.g. a key of a wrong type
+                self.shard_queues[0].put(msg)
+                continue
+
+            if request[0] == 'scan':
+                status, description = self.scan(msg, request)
+            elif request[0] == 'stats':
+                results = self.gather(msg)
+                status, description = True, {'shards': [description for _, description in results]}
+            else:
+                # let a shard report the error
+                self.shard_queues[0].put(msg)
+                continue
+
+            s = pack_response(status, description, values['request_hash'])
+            msg_to_send = ResponseMessage(s, self.manager.get_self_addr())
+            self.manager.send_msg_object(addr_tuple_to_str(msg['message'].source_addr), msg_to_send)
@@ -0,0 +1,303 @@
+import bisect
+import itertools
+import sys
+from array import array
+
+
+# bytes of the dict and block slots of an entry beyond its key, data and version objects (measured with tracemalloc)
+ENTRY_OVERHEAD = 90
+VERSION_SIZE = sys.getsizeof(2 ** 30 - 1)
+# bytes of the columns of a row of ArenaMemtable: key offset, key length, data offset, data length, version
+ROW_SIZE = 8 + 2 + 8 + 4 + 8
+
+
+class Memtable:
+    """Sorted in-memory table of the latest writes.
+
+    Data and versions are held in dicts for point lookups, keys are additionally kept in order in a two level,
+    B-tree style structure: a list of sorted blocks of at most 2 * block_size keys plus the first key of every block.
+    Inserting a key bisects the first keys and then its block (O(log n) comparisons), so the memtable can be iterated
+    in key order and seeked to a start key without sorting it.
+
+    size is the accounted memory of the entries: their key, data and version objects and ENTRY_OVERHEAD, adjusted on
+    overwrites. data_size counts the key and data bytes, measure_memory() measures the actual size of all objects.
+    """
+
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+        self.data = {}
+        self.versions = {}
+        self.blocks = []
+        self.first_keys = []
+        self.size = 0
+        self.data_size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        """Return [data, version] of key, or None if key is not in this memtable"""
+        if key in self.data:
+            return [self.data[key], self.versions[key]]
+        return None
+
+    def get_version(self, key):
+        return self.versions.get(key)
+
+    @staticmethod
+    def entry_size(key, data):
+        """Accounted memory of an entry"""
+        return sys.getsizeof(key) + sys.getsizeof(data) + VERSION_SIZE + ENTRY_OVERHEAD
+
+    def get_entry_size(self, key):
+        """Accounted memory of the entry of key, 0 if key is not in this memtable"""
+        if key not in self.data:
+            return 0
+        return Memtable.entry_size(key, self.data[key])
+
+    def growth(self, key, data):
+        """Accounted memory this memtable grows by when key is put with data"""
+        return Memtable.entry_size(key, data) - self.get_entry_size(key)
+
+    def put(self, key, data, version):
+        if key in self.data:
+            self.size = self.size - self.get_entry_size(key)
+            self.data_size = self.data_size - len(key) - len(self.data[key])
+        else:
+            self.insert_key(key)
+        self.data[key] = data
+        self.versions[key] = version
+        self.size = self.size + Memtable.entry_size(key, data)
+        self.data_size = self.data_size + len(key) + len(data)
+
+    def measure_memory(self):
+        """Size of all objects of this memtable (O(n))"""
+        memory = sys.getsizeof(self.data) + sys.getsizeof(self.versions) + sys.getsizeof(self.blocks) \
+            + sys.getsizeof(self.first_keys)
+        memory = memory + sum(sys.getsizeof(block) for block in self.blocks)
+        memory = memory + sum(sys.getsizeof(key) + sys.getsizeof(data) for key, data in self.data.items())
+        memory = memory + sum(sys.getsizeof(version) for version in self.versions.values())
+        return memory
+
+    def insert_key(self, key):
+        if not self.blocks:
+            self.blocks.append([key])
+            self.first_keys.append(key)
+            return
+
+        i = max(bisect.bisect_right(self.first_keys, key) - 1, 0)
+        block = self.blocks[i]
+        bisect.insort(block, key)
+        self.first_keys[i] = block[0]
+
+        if len(block) > 2 * self.block_size:
+            # split the block in two
+            self.blocks[i:i + 1] = [block[:self.block_size], block[self.block_size:]]
+            self.first_keys[i:i + 1] = [block[0], block[self.block_size]]
+
+    def items(self, start_key=None, end_key=None):
+        """Iterate (key, data, version) in key order, from start_key (inclusive) to end_key (exclusive)"""
+        if not self.blocks:
+            return
+        i, j = 0, 0
+        if start_key is not None:
+            i = max(bisect.bisect_right(self.first_keys, start_key) - 1, 0)
+            j = bisect.bisect_left(self.blocks[i], start_key)
+
+        for block in itertools.islice(self.blocks, i, None):
+            for key in itertools.islice(block, j, None):
+                if end_key is not None and key >= end_key:
+                    return
+                yield key, self.data[key], self.versions[key]
+            j = 0
+
+    def keys(self):
+        for block in self.blocks:
+            for key in block:
+                yield key
+
+
+class ArenaMemtable:
+    """Memtable without Python objects per entry.
+
+    Keys (utf-8) and data are appended to two bytearray arenas, the entries are rows of array-typed columns (key
+    offset and length, data offset and length, version). Rows are found through an open addressing hash table of row
+    numbers (array), and kept in key order in blocks of row numbers like in Memtable. Overwritten data stays in the data
+    arena until the memtable is flushed.
+
+    size is the memory of the arenas, columns, hash table and blocks, data_size the key and data bytes of the live
+    entries.
+    """
+
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+        self.key_arena = bytearray()
+        self.data_arena = bytearray()
+        self.key_offsets = array('Q')
+        self.key_lengths = array('H')
+        self.data_offsets = array('Q')
+        self.data_lengths = array('I')
+        self.versions = array('Q')
+        # row numbers, -1 for empty slots, at most half full
+        self.table = array('q', [-1]) * 16
+        self.blocks = []
+        self.first_keys = []
+        self.data_size = 0
+
+    @property
+    def size(self):
+        return len(self.key_arena) + len(self.data_arena) + len(self) * (ROW_SIZE + 4) \
+            + len(self.table) * self.table.itemsize
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __contains__(self, key):
+        return self.find(bytes(key, 'utf-8'))[0] >= 0
+
+    def get_key(self, row):
+        offset = self.key_offsets[row]
+        return bytes(self.key_arena[offset:offset + self.key_lengths[row]])
+
+    def get_data(self, row):
+        offset = self.data_offsets[row]
+        return bytes(self.data_arena[offset:offset + self.data_lengths[row]])
+
+    def find(self, b_key):
+        """(row of b_key or -1, its slot in the hash table)"""
+        mask = len(self.table) - 1
+        i = hash(b_key) & mask
+        while True:
+            row = self.table[i]
+            if row < 0:
+                return -1, i
+            offset = self.key_offsets[row]
+            if self.key_lengths[row] == len(b_key) and self.key_arena[offset:offset + len(b_key)] == b_key:
+                return row, i
+            i = (i + 1) & mask
+
+    def resize_table(self):
+        self.table = array('q', [-1]) * (len(self.table) * 2)
+        mask = len(self.table) - 1
+        for row in range(len(self)):
+            i = hash(self.get_key(row)) & mask
+            while self.table[i] >= 0:
+                i = (i + 1) & mask
+            self.table[i] = row
+
+    def get(self, key):
+        """Return [data, version] of key, or None if key is not in this memtable"""
+        row = self.find(bytes(key, 'utf-8'))[0]
+        if row < 0:
+            return None
+        return [self.get_data(row), self.versions[row]]
+
+    def get_version(self, key):
+        row = self.find(bytes(key, 'utf-8'))[0]
+        return self.versions[row] if row >= 0 else None
+
+    def growth(self, key, data):
+        """Memory this memtable grows by when key is put with data (at most)"""
+        b_key = bytes(key, 'utf-8')
+        row = self.find(b_key)[0]
+        if row >= 0:
+            return len(data)
+        return len(b_key) + len(data) + ROW_SIZE + 4 + 2 * self.table.itemsize
+
+    def put(self, key, data, version):
+        b_key = bytes(key, 'utf-8')
+        row, slot = self.find(b_key)
+        if row >= 0:
+            self.data_size = self.data_size - self.data_lengths[row]
+        else:
+            row = len(self)
+            self.table[slot] = row
+            self.key_offsets.append(len(self.key_arena))
+            self.key_lengths.append(len(b_key))
+            self.key_arena.extend(b_key)
+            self.data_offsets.append(0)
+            self.data_lengths.append(0)
+            self.versions.append(0)
+            self.data_size = self.data_size + len(b_key)
+            self.insert_row(row, b_key)
+            if len(self) * 2 > len(self.table):
+                self.resize_table()
+        self.data_offsets[row] = len(self.data_arena)
+        self.data_lengths[row] = len(data)
+        self.data_arena.extend(data)
+        self.versions[row] = version
+        self.data_size = self.data_size + len(data)
+
+    def bisect_block(self, block, b_key):
+        """Position of the first row of block whose key is not less than b_key"""
+        key_arena, key_offsets, key_lengths = self.key_arena, self.key_offsets, self.key_lengths
+        lo, hi = 0, len(block)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = block[mid]
+            offset = key_offsets[row]
+            if key_arena[offset:offset + key_lengths[row]] < b_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def insert_row(self, row, b_key):
+        if not self.blocks:
+            self.blocks.append(array('I', [row]))
+            self.first_keys.append(b_key)
+            return
+
+        i = max(bisect.bisect_right(self.first_keys, b_key) - 1, 0)
+        block = self.blocks[i]
+        j = self.bisect_block(block, b_key)
+        block.insert(j, row)
+        if j == 0:
+            self.first_keys[i] = b_key
+
+        if len(block) > 2 * self.block_size:
+            # split the block in two
+            self.blocks[i:i + 1] = [block[:self.block_size], block[self.block_size:]]
+            self.first_keys[i:i + 1] = [self.first_keys[i], self.get_key(block[self.block_size])]
+
+    def items(self, start_key=None, end_key=None):
+        """Iterate (key, data, version) in key order, from start_key (inclusive) to end_key (exclusive)"""
+        if not self.blocks:
+            return
+        b_end_key = bytes(end_key, 'utf-8') if end_key is not None else None
+        i, j = 0, 0
+        if start_key is not None:
+            b_start_key = bytes(start_key, 'utf-8')
+            i = max(bisect.bisect_right(self.first_keys, b_start_key) - 1, 0)
+            j = self.bisect_block(self.blocks[i], b_start_key)
+
+        for block in itertools.islice(self.blocks, i, None):
+            for row in itertools.islice(block, j, None):
+                b_key = self.get_key(row)
+                if b_end_key is not None and b_key >= b_end_key:
+                    return
+                yield b_key.decode('utf-8'), self.get_data(row), self.versions[row]
+            j = 0
+
+    def keys(self):
+        for block in self.blocks:
+            for row in block:
+                yield self.get_key(row).decode('utf-8')
+
+    def measure_memory(self):
+        """Size of all objects of this memtable"""
+        memory = sum(sys.getsizeof(column) for column in [self.key_arena, self.data_arena, self.key_offsets,
+                                                          self.key_lengths, self.data_offsets, self.data_lengths,
+                                                          self.versions, self.table, self.blocks, self.first_keys])
+        memory = memory + sum(sys.getsizeof(block) for block in self.blocks)
+        memory = memory + sum(sys.getsizeof(key) for key in self.first_keys)
+        return memory
+
+
+MEMTABLE_TYPES = {
+    'sorted': Memtable,
+    'arena': ArenaMemtable,
+}
@@ -0,0 +1,442 @@
+import bisect
+import csv
+import json
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from cassandra.engine.bloom_filter import BloomFilter, BLOOM_FILTER_FILE_EXT
+from cassandra.util import fsync_dir, fsync_file
+
+DATA_FILE_EXT = '.ssdf'
+INDEX_FILE_EXT = '.ssbi'
+LEGACY_INDEX_FILE_EXT = '.ssif'
+METADATA_FILE_EXT = '.ssmd'
+MANIFEST_FILE_NAME = 'manifest.json'
+MANIFEST_FORMAT_VERSION = 1
+
+INDEX_MAGIC = b'SSBI'
+INDEX_FORMAT_VERSION = 1
+
+# default interval of the index summary: every INDEX_SUMMARY_INTERVAL-th key of an index is kept in memory
+INDEX_SUMMARY_INTERVAL = 128
+
+_HEADER = struct.Struct('>4sHI')        # magic, format version, entry count
+_OFFSET = struct.Struct('>Q')           # position of an entry in the entries section
+_KEY_LENGTH = struct.Struct('>H')
+_ENTRY_VALUE = struct.Struct('>QIQ')    # data offset, data length, version
+
+COMPRESSION_ALGORITHMS = ['zlib']
+
+
+def generation(name):
+    """Sort key of an SSTable name: '<flush time in ms>' or '<name of the newest input>-<n>' for compaction output"""
+    return tuple(int(part) for part in name.split('-'))
+
+
+def compacted_name(name, existing_names):
+    """Name of a compaction output that sorts right after name, its newest input, and is not in existing_names"""
+    base = generation(name)[0]
+    suffixes = [generation(n)[-1] for n in existing_names if generation(n)[0] == base and '-' in n]
+    return '%d-%d' % (base, max(suffixes + [0]) + 1)
+
+
+def encode_block_offset(block, offset_in_block):
+    """Data offset of a row of a compressed SSTable: block number (high 32 bits), offset in the block (low 32 bits)"""
+    return block << 32 | offset_in_block
+
+
+def decode_block_offset(offset):
+    return offset >> 32, offset & 0xffffffff
+
+
+def write_metadata(metadata_file_path, metadata):
+    """Write the metadata of an SSTable: JSON of {level, min_key, max_key, entries, size, compression}
+
+    size is the uncompressed size of the rows. compression is None for plain data files, or
+    {algorithm, block_size, block_offsets} for block-compressed ones (block_offsets holds the position of every block in
+    the data file followed by the file size).
+    """
+    tmp_path = metadata_file_path + '.tmp'
+    with open(tmp_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+        fsync_file(metadata_file)
+    os.replace(tmp_path, metadata_file_path)
+
+
+def read_metadata(metadata_file_path):
+    with open(metadata_file_path, 'r') as metadata_file:
+        return json.load(metadata_file)
+
+
+def write_manifest(manifest_file_path, sstables, obsolete=()):
+    """Write the manifest of a data directory, the list of its live SSTables.
+
+    Manifest format: JSON of {format_version, sstables: [...], obsolete: [...]}, SSTables oldest first, each of them
+    {name, generation, <metadata>, data_file, index_file, bloom_filter_file, metadata_file}. The index file holds the
+    key samples of the index summary. obsolete names the SSTables merged by compaction whose files may not be removed
+    yet.
+
+    sstables: list of (name, metadata), oldest first
+    """
+    manifest = {'format_version': MANIFEST_FORMAT_VERSION, 'sstables': [], 'obsolete': list(obsolete)}
+    for name, metadata in sstables:
+        manifest['sstables'].append(dict(
+            metadata,
+            name=name,
+            generation=generation(name),
+            data_file=name + DATA_FILE_EXT,
+            index_file=name + INDEX_FILE_EXT,
+            bloom_filter_file=name + BLOOM_FILTER_FILE_EXT,
+            metadata_file=name + METADATA_FILE_EXT,
+        ))
+
+    # the manifest is the only record of which SSTables are live, so it is synced before it replaces the old one and
+    # the directory is synced after. The SSTables it lists were synced when they were written (SSTableWriter.close).
+    tmp_path = manifest_file_path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+        fsync_file(manifest_file)
+    os.replace(tmp_path, manifest_file_path)
+    fsync_dir(os.path.dirname(manifest_file_path))
+
+
+def read_manifest(manifest_file_path):
+    """Read a manifest, returns the list of (name, metadata) of its SSTables, oldest first, and the names of the
+    obsolete SSTables"""
+    with open(manifest_file_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format_version') != MANIFEST_FORMAT_VERSION:
+        raise ValueError('%s has unknown manifest format version %s'
+                         % (manifest_file_path, manifest.get('format_version')))
+    sstables = []
+    for entry in manifest['sstables']:
+        metadata = {k: entry.get(k) for k in ['level', 'min_key', 'max_key', 'entries', 'size', 'compression']}
+        sstables.append((entry['name'], metadata))
+    return sstables, manifest.get('obsolete', [])
+
+
+def encode_index_entry(key, offset, length, version):
+    b_key = bytes(key, 'utf-8')
+    return _KEY_LENGTH.pack(len(b_key)) + b_key + _ENTRY_VALUE.pack(offset, length, version)
+
+
+def write_index(index_file_path, entries):
+    """Write a binary index file.
+
+    Binary index file format (all integers are big-endian):
+        header:  magic 'SSBI' (4s) | format version (H) | entry count (I)
+        offsets: entry count * position of the entry in the entries section (Q)
+        entries: key length (H) | key (utf-8) | data offset (Q) | data length (I) | version (Q)
+
+    The data offset of a row of a compressed SSTable is its block and offset in the block (see encode_block_offset).
+
+    entries: iterable of (key, offset, length, version), sorted on key
+    """
+    encoded = [encode_index_entry(*entry) for entry in entries]
+
+    tmp_path = index_file_path + '.tmp'
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(_HEADER.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION, len(encoded)))
+        position = 0
+        for e in encoded:
+            index_file.write(_OFFSET.pack(position))
+            position = position + len(e)
+        for e in encoded:
+            index_file.write(e)
+        fsync_file(index_file)
+    os.replace(tmp_path, index_file_path)
+
+
+def read_legacy_index(legacy_index_file_path):
+    """Read a CSV index file (key,start,length,version per row) into a sorted list of entries"""
+    entries = []
+    with open(legacy_index_file_path, 'r') as csv_file:
+        for row in csv.reader(csv_file, delimiter=','):
+            entries.append((row[0], int(row[1]), int(row[2]), int(row[3])))
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+def convert_index_file(legacy_index_file_path, index_file_path):
+    """Convert a CSV index file (.ssif) to the binary index format"""
+    entries = read_legacy_index(legacy_index_file_path)
+    write_index(index_file_path, entries)
+    return len(entries)
+
+
+class SSTableWriter:
+    """Writer of the data, index, bloom filter and metadata files of one SSTable, rows have to be appended in key
+    order.
+
+    With compression (e.g. 'zlib') rows are collected in blocks of about block_size bytes that are compressed
+    separately, a row never spans two blocks. offset counts the uncompressed bytes written.
+
+    The index is written last, an SSTable without index is ignored when the data directory is loaded. close syncs all
+    files and the directory to disk, so the SSTable survives a crash once close returns and the commit log segment
+    of its rows may be discarded.
+    """
+
+    def __init__(self, data_file_path, index_file_path, bloom_filter_file_path, metadata_file_path, fp_chance,
+                 level=0, compression=None, block_size=65536):
+        if compression is not None and compression not in COMPRESSION_ALGORITHMS:
+            raise ValueError('Unknown compression %s, expected one of %s' % (compression, COMPRESSION_ALGORITHMS))
+        self.index_file_path = index_file_path
+        self.bloom_filter_file_path = bloom_filter_file_path
+        self.metadata_file_path = metadata_file_path
+        self.fp_chance = fp_chance
+        self.level = level
+        self.compression = compression
+        self.block_size = block_size
+        self.data_file = open(data_file_path, 'wb')
+        self.index = []
+        self.offset = 0
+        self.block = bytearray()
+        self.block_offsets = [0]
+
+    def append(self, key, data, version):
+        length = len(data)
+        if self.compression is None:
+            self.index.append((key, self.offset, length, version))
+            self.data_file.write(data)
+        else:
+            self.index.append((key, encode_block_offset(len(self.block_offsets) - 1, len(self.block)), length, version))
+            self.block.extend(data)
+            if len(self.block) >= self.block_size:
+                self.write_block()
+        self.offset = self.offset + length
+
+    def write_block(self):
+        compressed = zlib.compress(bytes(self.block))
+        self.data_file.write(compressed)
+        self.block_offsets.append(self.block_offsets[-1] + len(compressed))
+        self.block = bytearray()
+
+    def close(self):
+        """Finish the SSTable, returns its bloom filter and metadata"""
+        if self.block:
+            self.write_block()
+        fsync_file(self.data_file)
+        self.data_file.close()
+        bloom_filter = BloomFilter.for_capacity(len(self.index), self.fp_chance)
+        for entry in self.index:
+            bloom_filter.add(entry[0])
+        bloom_filter.write(self.bloom_filter_file_path)
+        metadata = {
+            'level': self.level,
+            'min_key': self.index[0][0] if self.index else None,
+            'max_key': self.index[-1][0] if self.index else None,
+            'entries': len(self.index),
+            'size': self.offset,
+            'compression': None,
+        }
+        if self.compression is not None:
+            metadata['compression'] = {
+                'algorithm': self.compression,
+                'block_size': self.block_size,
+                'block_offsets': self.block_offsets,
+            }
+        write_metadata(self.metadata_file_path, metadata)
+        write_index(self.index_file_path, self.index)
+        fsync_dir(os.path.dirname(self.index_file_path))
+        return bloom_filter, metadata
+
+
+class IndexSummary:
+    """Sampled summary of an index: the key and the position (in the entries section) of every interval-th entry.
+
+    Its memory is proportional to the number of entries / interval. The entries from sample s up to the next sample
+    form window s, which is stored contiguously in the index file.
+    """
+
+    def __init__(self, interval, keys, positions, count):
+        self.interval = interval
+        self.keys = keys
+        self.positions = positions
+        self.count = count
+
+    def find_window(self, key):
+        """Window whose first key is the greatest one not greater than key, -1 if key is before the first entry"""
+        return bisect.bisect_right(self.keys, key) - 1
+
+    def measure_memory(self):
+        return sys.getsizeof(self.keys) + sum(sys.getsizeof(key) for key in self.keys) + sys.getsizeof(self.positions)
+
+
+class IndexReader:
+    """Reader of a binary index file.
+
+    Only a sampled summary (every summary_interval-th key, see IndexSummary) is held in memory. It is built when the
+    first lookup needs it, or passed in when the index is reopened. A lookup bisects the summary, reads the selected
+    window of at most summary_interval entries at once and bisects it in memory.
+    """
+
+    def __init__(self, index_file_path, summary_interval=INDEX_SUMMARY_INTERVAL, summary=None):
+        self.path = index_file_path
+        self.file = open(index_file_path, 'rb')
+
+        magic, version, self.count = _HEADER.unpack(self.file.read(_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_FORMAT_VERSION:
+            self.file.close()
+            raise ValueError('%s is not a binary index file (magic %s, version %d)' % (index_file_path, magic, version))
+
+        self.entries_start = _HEADER.size + self.count * _OFFSET.size
+        self.summary_interval = summary_interval
+        self._summary = summary
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            self._summary = self.read_summary()
+        return self._summary
+
+    def read_summary(self):
+        keys = []
+        positions = array('Q')
+        for i in range(0, self.count, self.summary_interval):
+            positions.append(self.read_position(i))
+            keys.append(self.read_entry(i)[0])
+        return IndexSummary(self.summary_interval, keys, positions, self.count)
+
+    def close(self):
+        self.file.close()
+
+    def read_position(self, i):
+        self.file.seek(_HEADER.size + i * _OFFSET.size)
+        return _OFFSET.unpack(self.file.read(_OFFSET.size))[0]
+
+    def read_entry(self, i):
+        position = self.read_position(i)
+        self.file.seek(self.entries_start + position)
+        key_length, = _KEY_LENGTH.unpack(self.file.read(_KEY_LENGTH.size))
+        key = self.file.read(key_length).decode('utf-8')
+        offset, length, version = _ENTRY_VALUE.unpack(self.file.read(_ENTRY_VALUE.size))
+        return key, offset, length, version
+
+    def read_window(self, s):
+        """Entries of window s of the summary: (bytes of the entries, position of every entry in these bytes).
+
+        The window is read with one read of its entry positions and one read of its entries.
+        """
+        summary = self.summary
+        first = s * self.summary_interval
+        n = min(self.summary_interval, self.count - first)
+        self.file.seek(_HEADER.size + first * _OFFSET.size)
+        positions = struct.unpack('>%dQ' % n, self.file.read(n * _OFFSET.size))
+        if s + 1 < len(summary.positions):
+            end = summary.positions[s + 1]
+        else:
+            end = os.fstat(self.file.fileno()).st_size - self.entries_start
+        start = positions[0]
+        self.file.seek(self.entries_start + start)
+        return self.file.read(end - start), [position - start for position in positions]
+
+    @staticmethod
+    def window_key(window, position):
+        key_length, = _KEY_LENGTH.unpack_from(window, position)
+        position = position + _KEY_LENGTH.size
+        return window[position:position + key_length].decode('utf-8')
+
+    def bisect_window(self, key):
+        """(window, entry positions in it, position in the window of the first entry whose key is not less than key),
+        None if key is before the first entry"""
+        s = self.summary.find_window(key)
+        if s < 0:
+            return None
+        window, positions = self.read_window(s)
+        lo, hi = 0, len(positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.window_key(window, positions[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return s, window, positions, lo
+
+    def search(self, key):
+        """Return [offset, length, version] of key, or None if key is not in this index"""
+        found = self.bisect_window(key)
+        if found is None:
+            return None
+        _, window, positions, i = found
+        if i == len(positions) or self.window_key(window, positions[i]) != key:
+            return None
+        key_length, = _KEY_LENGTH.unpack_from(window, positions[i])
+        return list(_ENTRY_VALUE.unpack_from(window, positions[i] + _KEY_LENGTH.size + key_length))
+
+    def lower_bound(self, key):
+        """Position of the first entry whose key is not less than key"""
+        found = self.bisect_window(key)
+        if found is None:
+            return 0
+        s, _, _, i = found
+        return s * self.summary_interval + i
+
+    def iter_from(self, start_key=None, end_key=None):
+        """Iterate (key, offset, length, version) from start_key (inclusive) to end_key (exclusive).
+
+        Every entry is read with its own seek, so several of these iterators (and searches) can be interleaved.
+        """
+        i = self.lower_bound(start_key) if start_key is not None else 0
+        while i < self.count:
+            entry = self.read_entry(i)
+            if end_key is not None and entry[0] >= end_key:
+                return
+            yield entry
+            i = i + 1
+
+    def __iter__(self):
+        # entries are stored in key order, so iterating is a sequential read
+        self.file.seek(self.entries_start)
+        for _ in range(self.count):
+            key_length, = _KEY_LENGTH.unpack(self.file.read(_KEY_LENGTH.size))
+            key = self.file.read(key_length).decode('utf-8')
+            offset, length, version = _ENTRY_VALUE.unpack(self.file.read(_ENTRY_VALUE.size))
+            yield key, offset, length, version
+
+    def __len__(self):
+        return self.count
+
+
+def iter_sstable(data_file_path, index_file_path, compression=None):
+    """Iterate (key, version, data) over the rows of an SSTable in key order
+
+    compression: compression metadata of the SSTable (see write_metadata), None for a plain data file
+    """
+    index = IndexReader(index_file_path)
+    try:
+        with open(data_file_path, 'rb') as data_file:
+            if compression is None:
+                for key, offset, length, version in index:
+                    data_file.seek(offset)
+                    yield key, version, data_file.read(length)
+                return
+
+            # blocks are read sequentially, each of them once
+            block_offsets = compression['block_offsets']
+            block_number, block = -1, None
+            for key, offset, length, version in index:
+                b, offset_in_block = decode_block_offset(offset)
+                if length == 0:
+                    # may point past the last block
+                    yield key, version, b''
+                    continue
+                if b != block_number:
+                    data_file.seek(block_offsets[b])
+                    block = zlib.decompress(data_file.read(block_offsets[b + 1] - block_offsets[b]))
+                    block_number = b
+                yield key, version, block[offset_in_block:offset_in_block + length]
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    # convert CSV index files: python -m cassandra.engine.sstable <file.ssif> [<file.ssif> ...]
+    logging.basicConfig(level=logging.INFO)
+    for path in sys.argv[1:]:
+        index_path = os.path.splitext(path)[0] + INDEX_FILE_EXT
+        n = convert_index_file(path, index_path)
+        logging.info('SSTable | converted %s (%d entries) to %s' % (path, n, index_path))
@@ -1,66 +1,202 @@
-import csv
+import bisect
+import itertools
 import json
 import logging
+import mmap
 import os
 import time
 import signal
 import sys
+import threading
+import zlib
 from multiprocessing import Process
 
-from cassandra.util.cache import LRUCache
-from cassandra.util.message import ResponseMessage
+from cassandra.engine.bloom_filter import BloomFilter, BLOOM_FILTER_FILE_EXT
+from cassandra.engine.commit_log import CommitLog
+from cassandra.engine.memtable import MEMTABLE_TYPES
+from cassandra.engine.compaction import COMPACTION_STRATEGIES, merge_sstables
+from cassandra.engine.sstable import IndexReader, SSTableWriter, convert_index_file, iter_sstable, generation, \
+    compacted_name, decode_block_offset, read_metadata, write_metadata, INDEX_FILE_EXT, LEGACY_INDEX_FILE_EXT, \
+    read_manifest, write_manifest, DATA_FILE_EXT, METADATA_FILE_EXT, MANIFEST_FILE_NAME, COMPRESSION_ALGORITHMS, \
+    INDEX_SUMMARY_INTERVAL
+from cassandra.util import str_to_bool
+from cassandra.util.cache import LRUCache, SizedLRUCache
+from cassandra.util.message import BYTES_MARKER, ResponseMessage, pack_response
 from cassandra.util.message_codes import MESSAGE_CODE_REQUEST
 from cassandra.util.packing import addr_tuple_to_str
 
+# JSON of a scan row in a response besides the key, the version and the data length: [key,{"__bytes__":length},version],
+SCAN_ROW_FRAMING = len('[,{"%s":},],' % BYTES_MARKER)
+
 
 class DataStorage(Process):
     """Data storage for naive cassandra
 
-    Index file format: CSV (delimited by comma(,))
-        key1,start,length
-        key2,start,length
-        ...
+    Index file format: binary, sorted on key (see cassandra.engine.sstable.write_index)
+        header | fixed-width entry offsets | key1,start,length,version | key2,start,length,version | ...
+
+    Of every index only a summary (every index_summary_interval-th key, see cassandra.engine.sstable.IndexSummary)
+    stays in memory, for all live SSTables, so index memory is proportional to the number of entries divided by the
+    interval. A lookup bisects the summary and reads one window of the index file. At most max_indices_in_memory index
+    files are kept open.
+
+    Legacy index files (CSV, .ssif) are converted to the binary format when the data directory is loaded.
+
+    Data file format: raw bytes of the values (sorted on key, keys not in this file). With compression = zlib new
+    SSTables are written as zlib-compressed blocks of about compression_block_size bytes, their index entries point at
+    (block, offset in block). Decompressed blocks are kept in a cache of at most block_cache_size bytes.
+
+    Bloom filter file format: see cassandra.engine.bloom_filter.BloomFilter. Filters of all SSTables stay in memory
+    and are checked before an index is touched.
+
+    Data files are read through read-only memory mappings, at most max_mapped_data_files of them are mapped at a time
+    (least recently used mappings are closed first).
+
+    Metadata file format: JSON of {level, min_key, max_key, entries, size, compression}. A read only consults the
+    SSTables whose key range contains the key.
+
+    The manifest (manifest.json, see cassandra.engine.sstable.write_manifest) lists the live SSTables with their
+    metadata. It is replaced atomically whenever the SSTable list changes (flush, compaction) and read on startup, the
+    data directory is only scanned when it is missing. It also names the inputs of compactions whose files were not
+    removed yet: on startup their files and the temporary files of interrupted writes are removed.
+
+    SSTables are named after their flush time in ms and ordered oldest first by (-level, name), reads go newest first.
+    A background thread merges them with the compaction strategy of the node (compaction_strategy: size_tiered or
+    leveled, see cassandra.engine.compaction). With leveled compaction SSTables of level 1 and above do not overlap
+    within their level, so a read consults at most one of them per level. Merged SSTables take the place of their
+    inputs in table_index_names, which is only ever replaced, never modified in place. Files of merged SSTables are
+    removed by the request loop (release_obsolete_sstables), so no read can hit a removed file.
 
-    Data file format: ASCII (sorted on key, keys not in this file)
+    Writes are appended to a commit log (see cassandra.engine.commit_log) before they enter the memtable. The log is
+    replayed when the data directory is loaded and discarded once the memtable is flushed. With commit_log_sync = group
+    the responses to writes are held back until the group of writes they belong to is fsynced.
+
+    Memtable sizes are accounted in memory bytes (see cassandra.engine.memtable), a memtable is frozen when it would
+    grow past max_data_per_sstable. All memtables of the node (active and frozen, of every shard) are kept below
+    memtable_memory_budget bytes (0 for no budget): above it the shard with the most memtable memory flushes.
+
+    memtable_type selects the memtable: sorted (Memtable, dicts of Python objects) or arena (ArenaMemtable, bytearray
+    arenas and array columns without objects per row). Memtables keep their keys sorted, so they are written to
+    SSTables in key order without sorting. A full memtable is frozen and flushed by a background thread while writes
+    go to a new active memtable, reads check the active memtable and then the frozen ones (newest first). When more
+    than max_pending_flushes memtables are waiting to be flushed, writes wait for a flush (backpressure).
+
+    Keys are str, values are bytes from the request to the response: they are stored, logged, written and read
+    without being decoded, and requests and responses frame them as raw bytes (see cassandra.util.message).
+
+    Rows read from SSTables are kept in a row cache bounded to row_cache_size bytes (0 disables it). Writes to a key
+    invalidate its cached row.
+
+    The key cache maps up to key_cache_size keys (0 disables it) to the position of their latest row in the SSTables:
+    (SSTable, offset, length, version). It is filled by reads, so a cached key is read without consulting filters and
+    indices. Writes to a key invalidate its entry, entries of SSTables merged by compaction are dropped with them.
+
+    node may be None to drive the storage directly (e.g. in benchmarks), requests are then not received from the node.
+    A storage shard (see cassandra.engine.dispatcher) gets its requests through the manager given to it instead, and
+    answers the requests the dispatcher gathers from all shards (marked 'gather') through reply_queue.
     """
 
-    DATA_FILE_EXT = '.ssdf'
-    INDEX_FILE_EXT = '.ssif'
+    DATA_FILE_EXT = DATA_FILE_EXT
+    INDEX_FILE_EXT = INDEX_FILE_EXT
+    LEGACY_INDEX_FILE_EXT = LEGACY_INDEX_FILE_EXT
+    BLOOM_FILTER_FILE_EXT = BLOOM_FILTER_FILE_EXT
+    METADATA_FILE_EXT = METADATA_FILE_EXT
 
-    def __init__(self, node, config):
+    def __init__(self, node, config, manager=None, label="DataStorage", reply_queue=None, memory_usage=None, shard=0):
         super(DataStorage, self).__init__()
 
-        self.label = "DataStorage"
-        node.register(self.label, MESSAGE_CODE_REQUEST)
-        self.manager = node.get_manager(self.label)
+        self.label = label
+        self.manager = manager
+        self.reply_queue = reply_queue
+        # memtable memory of every shard of the node (shared array), this storage is shard
+        self.memory_usage = memory_usage
+        self.shard = shard
+        if node is not None:
+            node.register(self.label, MESSAGE_CODE_REQUEST)
+            self.manager = node.get_manager(self.label)
 
         # configurations
         self.datafile_dir = config.get('datafile_dir', 'data/')
         self.max_indices_in_memory = int(config.get('max_indices_in_memory', -1))
+        self.index_summary_interval = int(config.get('index_summary_interval', INDEX_SUMMARY_INTERVAL))
         self.max_data_per_sstable = int(config.get('max_data_per_sstable', 2 ** 20))  # 1M
+        self.bloom_filter_fp_chance = float(config.get('bloom_filter_fp_chance', 0.01))
+        self.mmap_data_files = str_to_bool(config.get('mmap_data_files', 'true'))
+        self.max_mapped_data_files = int(config.get('max_mapped_data_files', 64))
+        self.row_cache_size = int(config.get('row_cache_size', 0))
+        self.key_cache_size = int(config.get('key_cache_size', 0))
+        self.compression = config.get('compression', 'none')
+        self.compression = None if self.compression == 'none' else self.compression
+        if self.compression is not None and self.compression not in COMPRESSION_ALGORITHMS:
+            raise ValueError('Unknown compression %s, expected none or one of %s'
+                             % (self.compression, COMPRESSION_ALGORITHMS))
+        self.compression_block_size = int(config.get('compression_block_size', 65536))
+        self.block_cache_size = int(config.get('block_cache_size', 8 * 2 ** 20))  # 8M
+        # a batch of requests is handled together (request_batch_size = 1 handles every request on its own)
+        self.request_batch_size = int(config.get('request_batch_size', 1))
+        self.request_batch_wait = float(config.get('request_batch_wait', 0)) / 1000  # ms
+        # responses are sent in frames of at most 64KB
+        self.max_scan_page_size = int(config.get('max_scan_page_size', 32768))
+        self.compaction_interval = float(config.get('compaction_interval', 1))
+        self.max_pending_flushes = int(config.get('max_pending_flushes', 2))
+        self.memtable_memory_budget = int(config.get('memtable_memory_budget', 0))
+        self.memtable_type = MEMTABLE_TYPES[config.get('memtable_type', 'sorted')]
+        self.commit_log_dir = config.get('commit_log_dir', os.path.join(self.datafile_dir, 'commitlog'))
+        self.commit_log_sync = config.get('commit_log_sync', 'periodic')
+        self.commit_log_sync_period = float(config.get('commit_log_sync_period', 1000)) / 1000  # ms
+        self.commit_log_group_window = float(config.get('commit_log_group_window', 10)) / 1000  # ms
+        self.compaction_strategy = COMPACTION_STRATEGIES[config.get('compaction_strategy', 'size_tiered')](
+            config, self.max_data_per_sstable)
 
-        self.table_indices = LRUCache(self.max_indices_in_memory)
+        self.table_indices = LRUCache(self.max_indices_in_memory, on_evict=DataStorage.close_index)
+        # index summaries of the live SSTables, kept when their index file is closed
+        self.index_summaries = {}
+        self.data_file_maps = LRUCache(self.max_mapped_data_files, on_evict=DataStorage.close_data_file_map)
+        self.block_cache = SizedLRUCache(self.block_cache_size, lambda block_key, block: len(block))
+        self.row_cache = None
+        if self.row_cache_size > 0:
+            self.row_cache = SizedLRUCache(self.row_cache_size, DataStorage.get_row_size)
+        self.key_cache = None
+        if self.key_cache_size > 0:
+            self.key_cache = LRUCache(self.key_cache_size)
         self.table_index_names = []
-        self.memtable = {}
-        self.memversions = {}
-        self.memtable_size = 0
+        self.sstable_metadata = {}
+        # (level 0 SSTables newest first, [(min keys, max keys, names, overlapping) of every other level])
+        self.sstable_view = ([], [])
+        self.sstables_lock = threading.Lock()
+        self.obsolete_sstables = []
+        self.compaction_event = threading.Event()
+        self.compaction_stats = {'compactions': 0, 'compacted_sstables': 0}
+        self.bloom_filters = {}
+        # misses: lookups skipped by a filter, hits: lookups passed to the index (including false positives)
+        self.bloom_filter_stats = {'hits': 0, 'misses': 0, 'false_positives': 0}
+        # reads: gets not answered by the memtable, sstables: SSTables consulted by them
+        self.read_amplification_stats = {'reads': 0, 'sstables': 0}
+        self.memtable = self.memtable_type()
+        # memtables waiting to be flushed, oldest first: {memtable, segment_id}, replaced (not
+        # modified) under sstables_lock
+        self.frozen_memtables = []
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.background_flush = False
+        # background tasks (compaction, flush, periodic commit log sync) run until stopped is set
+        self.background_threads = []
+        self.stopped = threading.Event()
+        self.flush_stats = {'flushes': 0, 'backpressure_waits': 0, 'budget_flushes': 0, 'budget_waits': 0}
+        # responses held back until the commit log is synced (group commit)
+        self.pending_responses = []
 
         self.load_dir(self.datafile_dir)
 
     def put(self, key, data):
 
         try:
-            if key in self.memtable:
-                self.memtable[key] = data
-                self.memversions[key] = self.memversions[key] + 1
-                return True, 'Ok'
-
-            length = len(data)
-            if self.memtable_size + length > self.max_data_per_sstable:
-                self.flush_to_file()
-            self.memtable[key] = data
-            self.memtable_size = self.memtable_size + length
-            self.memversions[key] = self.get_version(key) + 1
+            if self.memtable.size + self.memtable.growth(key, data) > self.max_data_per_sstable:
+                self.freeze_memtable()
+            version = self.get_version(key) + 1
+            self.commit_log.append(key, data, version)
+            self.apply(key, data, version)
+            self.check_memory_budget()
             return True, 'Ok'
 
         except Exception as e:
@@ -68,12 +204,72 @@ class DataStorage(Process):
             logging.error('%s | %s' % (self.label, error_message), exc_info=True)
             return False, error_message
 
+    def put_many(self, rows):
+        """put of several (key, data) rows in order: their versions are looked up together and the rows are logged with
+        one commit log write (one per memtable if the memtable fills up)"""
+        try:
+            versions = self.get_versions([key for key, _ in rows])
+            batch = []
+            # growth of the memtable by batch (estimated against the memtable without the batch)
+            batch_size = 0
+            for key, data in rows:
+                growth = self.memtable.growth(key, data)
+                if self.memtable.size + batch_size + growth > self.max_data_per_sstable:
+                    self.write_batch(batch)
+                    self.freeze_memtable()
+                    batch, batch_size = [], 0
+                    growth = self.memtable.growth(key, data)
+                batch_size = batch_size + growth
+                versions[key] = versions[key] + 1
+                batch.append((key, data, versions[key]))
+            self.write_batch(batch)
+            self.check_memory_budget()
+            return True, 'Ok'
+
+        except Exception as e:
+            error_message = 'Error occurred when put %d rows into database: %s' % (len(rows), e)
+            logging.error('%s | %s' % (self.label, error_message), exc_info=True)
+            return False, error_message
+
+    def write_batch(self, records):
+        self.commit_log.append_many(records)
+        for key, data, version in records:
+            self.apply(key, data, version)
+
+    def get_many(self, keys):
+        """get of several keys, returns {key: [data, version] or []}. Keys missing in the memtables and the row cache
+        are searched SSTable by SSTable (see search_in_indices_many) and their data is read in file order."""
+        try:
+            result = {}
+            missing = []
+            for key in keys:
+                data = self.get_data_from_memtable(key)
+                if len(data) == 0 and self.row_cache is not None:
+                    data = self.row_cache.get(key) or []
+                if len(data) == 0:
+                    missing.append(key)
+                result[key] = data
+
+            found = self.search_in_indices_many(set(missing), count_reads=True)
+            for key in sorted(found, key=found.get):
+                index_key, (offset, length, version) = found[key]
+                result[key] = [self.read_data(index_key, offset, length), version]
+                self.set_key_cache(key, index_key, offset, length, version)
+                if self.row_cache is not None:
+                    self.row_cache.set(key, result[key])
+            return True, result
+
+        except Exception as e:
+            error_message = 'Error occurred when get %d keys from database: %s' % (len(keys), e)
+            logging.error('%s | %s' % (self.label, error_message), exc_info=True)
+            return False, error_message
+
     def get(self, key):
         try:
             # return True, self.get_data_from_memtable(key) + self.get_data_from_sstables(key)
             data = self.get_data_from_memtable(key)
             if len(data) == 0:
-                data = self.get_data_from_sstables(key)
+                data = self.get_data_from_row_cache(key)
             return True, data
 
         except Exception as e:
@@ -83,161 +279,880 @@ class DataStorage(Process):
 
     def update(self, key, value, version):
         try:
-            self.memtable[key] = value
-            self.memversions[key] = version
+            self.commit_log.append(key, value, version)
+            self.apply(key, value, version)
+            self.check_memory_budget()
             return True, 'update version of %s to %d' % (key, version)
         except Exception as e:
             error_message = 'Error occurred when get (%s) into database: %s' % (key, e)
             logging.error('%s | %s' % (self.label, error_message), exc_info=True)
             return False, error_message
 
+    def apply(self, key, data, version):
+        # put a logged write into the memtable
+        self.memtable.put(key, data, version)
+        if self.row_cache is not None:
+            self.row_cache.pop(key)
+        if self.key_cache is not None:
+            self.key_cache.pop(key)
+
     def get_index_file_path(self, index_file_name):
         return os.path.join(self.datafile_dir, index_file_name + DataStorage.INDEX_FILE_EXT)
 
+    def get_legacy_index_file_path(self, index_file_name):
+        return os.path.join(self.datafile_dir, index_file_name + DataStorage.LEGACY_INDEX_FILE_EXT)
+
     def get_data_file_path(self, data_file_name):
         return os.path.join(self.datafile_dir, data_file_name + DataStorage.DATA_FILE_EXT)
 
+    def get_bloom_filter_file_path(self, bloom_filter_file_name):
+        return os.path.join(self.datafile_dir, bloom_filter_file_name + DataStorage.BLOOM_FILTER_FILE_EXT)
+
+    def get_metadata_file_path(self, metadata_file_name):
+        return os.path.join(self.datafile_dir, metadata_file_name + DataStorage.METADATA_FILE_EXT)
+
     def load_dir(self, datafile_dir):
         # read the datafile_dir and initiate the table_index_names
         if not os.path.exists(datafile_dir):
             os.makedirs(datafile_dir)
 
-        data_file_list = []
-        index_file_list = []
+        table_index_names = None
+        if os.path.isfile(self.get_manifest_path()):
+            try:
+                table_index_names = self.load_manifest()
+            except (ValueError, KeyError) as e:
+                logging.error('DataStorage | Manifest can not be read, scanning the data directory: %s' % e)
+        if table_index_names is None:
+            table_index_names = self.scan_dir(datafile_dir)
+        self.set_sstables(table_index_names)
+
+        self.commit_log = CommitLog(self.commit_log_dir, self.commit_log_sync, self.commit_log_sync_period,
+                                    self.commit_log_group_window)
+        replayed = 0
+        for key, data, version in self.commit_log.replay():
+            self.apply(key, data, version)
+            replayed = replayed + 1
+        if replayed > 0:
+            logging.info('DataStorage | Replayed %d writes from the commit log.' % replayed)
+            if self.memtable.size > self.max_data_per_sstable:
+                self.flush_to_file()
+
+    def get_manifest_path(self):
+        return os.path.join(self.datafile_dir, MANIFEST_FILE_NAME)
+
+    def load_manifest(self):
+        """Load the SSTables listed in the manifest, returns their names"""
+        table_index_names = []
+        sstables, obsolete = read_manifest(self.get_manifest_path())
+        for name, metadata in sstables:
+            if not os.path.isfile(self.get_index_file_path(name)) \
+                    and os.path.isfile(self.get_legacy_index_file_path(name)):
+                self.convert_legacy_index(name)
+            if not os.path.isfile(self.get_index_file_path(name)) or not os.path.isfile(self.get_data_file_path(name)):
+                logging.error('DataStorage | Files of %s in the manifest not found. Ignoring.' % name)
+                continue
+            self.sstable_metadata[name] = metadata
+            self.load_bloom_filter(name)
+            table_index_names.append(name)
+        live_names = set(name for name, _ in sstables)
+        self.remove_leftover_files([name for name in obsolete if name not in live_names])
+        return table_index_names
+
+    def remove_leftover_files(self, obsolete):
+        """Remove the files of the compacted SSTables obsolete (see write_manifest) and the temporary files of
+        SSTable and manifest writes interrupted by a crash"""
+        paths = []
+        for name in obsolete:
+            paths.extend([self.get_data_file_path(name), self.get_index_file_path(name),
+                          self.get_legacy_index_file_path(name), self.get_bloom_filter_file_path(name),
+                          self.get_metadata_file_path(name)])
+        extensions = {DataStorage.INDEX_FILE_EXT, DataStorage.BLOOM_FILTER_FILE_EXT, DataStorage.METADATA_FILE_EXT}
+        for f in os.listdir(self.datafile_dir):
+            if f.endswith('.tmp') and (os.path.splitext(f[:-len('.tmp')])[1] in extensions
+                                       or f == MANIFEST_FILE_NAME + '.tmp'):
+                paths.append(os.path.join(self.datafile_dir, f))
+        for path in paths:
+            if os.path.isfile(path):
+                os.remove(path)
+                logging.warning('DataStorage | Removed %s left by a compaction or an interrupted write.' % path)
+
+    def scan_dir(self, datafile_dir):
+        """Find and load the SSTables of datafile_dir, returns their names"""
+        data_files = set()
+        index_files = set()
+        legacy_index_files = set()
 
         for f in os.listdir(datafile_dir):
             if os.path.isfile(os.path.join(datafile_dir, f)):
                 name, ext = os.path.splitext(f)
                 if ext == DataStorage.DATA_FILE_EXT:
-                    data_file_list.append(name)
+                    data_files.add(name)
                 elif ext == DataStorage.INDEX_FILE_EXT:
-                    index_file_list.append(name)
-        self.table_index_names = [i for i in data_file_list if i in index_file_list]
+                    index_files.add(name)
+                elif ext == DataStorage.LEGACY_INDEX_FILE_EXT:
+                    legacy_index_files.add(name)
 
-        diff1 = [i for i in data_file_list if i not in index_file_list]
-        diff2 = [i for i in index_file_list if i not in data_file_list]
+        for name in legacy_index_files - index_files:
+            self.convert_legacy_index(name)
+            index_files.add(name)
 
-        for name in diff1:
+        for name in data_files - index_files:
             logging.error('DataStorage | IndexFile for %s not found. Ignoring.' % name)
-        for name in diff2:
+        for name in index_files - data_files:
             logging.error('DataStorage | Datafile for %s not found. Ignoring.' % name)
 
-    def flush_to_file(self):
+        table_index_names = list(data_files & index_files)
+        for name in table_index_names:
+            self.load_metadata(name)
+            self.load_bloom_filter(name)
+        return table_index_names
+
+    def convert_legacy_index(self, name):
+        n = convert_index_file(self.get_legacy_index_file_path(name), self.get_index_file_path(name))
+        os.remove(self.get_legacy_index_file_path(name))
+        logging.info('DataStorage | Converted CSV index of %s (%d entries) to binary index.' % (name, n))
+
+    def load_metadata(self, index_key):
+        metadata_file_path = self.get_metadata_file_path(index_key)
+        if os.path.isfile(metadata_file_path):
+            metadata = read_metadata(metadata_file_path)
+        else:
+            # SSTables written before metadata existed
+            index = self.read_index_file(index_key)
+            metadata = {
+                'level': 0,
+                'min_key': index.read_entry(0)[0] if len(index) else None,
+                'max_key': index.read_entry(len(index) - 1)[0] if len(index) else None,
+                'entries': len(index),
+                'size': os.path.getsize(self.get_data_file_path(index_key)),
+                'compression': None,
+            }
+            write_metadata(metadata_file_path, metadata)
+            logging.info('DataStorage | Built metadata for %s.' % index_key)
+        self.sstable_metadata[index_key] = metadata
+
+    def load_bloom_filter(self, index_key):
+        bloom_filter_file_path = self.get_bloom_filter_file_path(index_key)
+        if os.path.isfile(bloom_filter_file_path):
+            bloom_filter = BloomFilter.read(bloom_filter_file_path)
+        else:
+            # SSTables written before bloom filters existed
+            index = self.read_index_file(index_key)
+            bloom_filter = BloomFilter.for_capacity(len(index), self.bloom_filter_fp_chance)
+            for entry in index:
+                bloom_filter.add(entry[0])
+            bloom_filter.write(bloom_filter_file_path)
+            logging.info('DataStorage | Built bloom filter for %s.' % index_key)
+        self.bloom_filters[index_key] = bloom_filter
+
+    def get_sstable_age(self, index_key):
+        # sort key of SSTables, oldest first
+        return -self.sstable_metadata[index_key]['level'], generation(index_key)
+
+    def set_sstables(self, names):
+        """Replace the SSTable list, the read view and the manifest, callers (except load_dir) hold sstables_lock"""
+        names = sorted(names, key=self.get_sstable_age)
+        levels = {}
+        for name in names:
+            metadata = self.sstable_metadata[name]
+            if metadata['entries']:
+                levels.setdefault(metadata['level'], []).append((name, metadata))
+
+        level0 = [(name, metadata['min_key'], metadata['max_key']) for name, metadata in reversed(levels.pop(0, []))]
+        other_levels = []
+        for level in sorted(levels):
+            tables = sorted(levels[level], key=lambda t: t[1]['min_key'])
+            min_keys = [metadata['min_key'] for _, metadata in tables]
+            max_keys = [metadata['max_key'] for _, metadata in tables]
+            overlapping = any(max_keys[i] >= min_keys[i + 1] for i in range(len(tables) - 1))
+            if overlapping:
+                # left by another compaction strategy, every SSTable of the level has to be consulted, newest first
+                tables = list(reversed(levels[level]))
+                min_keys = [metadata['min_key'] for _, metadata in tables]
+                max_keys = [metadata['max_key'] for _, metadata in tables]
+            other_levels.append((min_keys, max_keys, [name for name, _ in tables], overlapping))
+
+        self.sstable_view = (level0, other_levels)
+        self.table_index_names = names
+        write_manifest(self.get_manifest_path(), [(name, self.sstable_metadata[name]) for name in names],
+                       self.obsolete_sstables)
+
+    def get_sstables_for_key(self, key):
+        """SSTables that may contain key, newest first"""
+        level0, other_levels = self.sstable_view
+        for name, min_key, max_key in level0:
+            if min_key <= key <= max_key:
+                yield name
+        for min_keys, max_keys, names, overlapping in other_levels:
+            if overlapping:
+                for i in range(len(names)):
+                    if min_keys[i] <= key <= max_keys[i]:
+                        yield names[i]
+            else:
+                i = bisect.bisect_right(min_keys, key) - 1
+                if i >= 0 and key <= max_keys[i]:
+                    yield names[i]
+
+    def get_sstable_writer(self, index_key, level=0):
+        return SSTableWriter(self.get_data_file_path(index_key), self.get_index_file_path(index_key),
+                             self.get_bloom_filter_file_path(index_key), self.get_metadata_file_path(index_key),
+                             self.bloom_filter_fp_chance, level, self.compression, self.compression_block_size)
+
+    def new_sstable_name(self):
+        # flush time in ms, kept strictly increasing
+        index_key = int(time.time() * 1000)
+        if self.table_index_names:
+            index_key = max(index_key, max(generation(name)[0] for name in self.table_index_names) + 1)
+        return str(index_key)
+
+    def freeze_memtable(self):
+        """Hand the active memtable over to the flush thread and start a new one"""
         if len(self.memtable) == 0:
             return
-        index_key = str(int(time.time() * 1000))
-        with open(self.get_index_file_path(index_key), 'w') as index_file:
-            with open(self.get_data_file_path(index_key), 'wb') as data_file:
-                keys = sorted(self.memtable.keys())
-                offset = 0
-                for key in keys:
-                    data = self.memtable[key]
-                    length = len(data)
-                    version = self.memversions[key]
-                    index_file.write(','.join([key, str(offset), str(length), str(version)]) + '\n')
-                    data_file.write(bytes(data, 'ascii'))
-                    offset = offset + length
-                # padding to fix number
-                # padding = self.max_data_per_sstable - offset
-                # data_file.write(bytes([0] * padding))
-                # clear memtable
-                self.memtable.clear()
-                self.memtable_size = 0
-                self.table_index_names.append(index_key)
+        frozen = {
+            'memtable': self.memtable,
+            'segment_id': self.commit_log.roll(),
+        }
+        with self.sstables_lock:
+            self.frozen_memtables = self.frozen_memtables + [frozen]
+        self.memtable = self.memtable_type()
+        self.flush_event.set()
+
+        if not self.background_flush:
+            self.flush_frozen_memtables()
+        elif len(self.frozen_memtables) > self.max_pending_flushes:
+            self.flush_stats['backpressure_waits'] += 1
+            while len(self.frozen_memtables) > self.max_pending_flushes:
+                self.flush_frozen_memtable()
+
+    def flush_frozen_memtable(self):
+        """Write the oldest frozen memtable to an SSTable, returns False if there was none"""
+        with self.flush_lock:
+            if not self.frozen_memtables:
+                return False
+            frozen = self.frozen_memtables[0]
+
+            index_key = self.new_sstable_name()
+            writer = self.get_sstable_writer(index_key)
+            for key, data, version in frozen['memtable'].items():
+                writer.append(key, data, version)
+            # close syncs the files of the SSTable and the directory, its commit log segment is discarded after that
+            self.bloom_filters[index_key], self.sstable_metadata[index_key] = writer.close()
+
+            # the SSTable becomes visible before the memtable is dropped, so reads always find one of them
+            with self.sstables_lock:
+                self.set_sstables(self.table_index_names + [index_key])
+                self.frozen_memtables = self.frozen_memtables[1:]
+            self.flush_stats['flushes'] += 1
+            self.update_memory_usage()
+
+            self.commit_log.discard(frozen['segment_id'])
+            self.compaction_event.set()
+            return True
+
+    def get_memtable_memory(self):
+        """Accounted memory of the active and frozen memtables"""
+        return self.memtable.size + sum(frozen['memtable'].size for frozen in self.frozen_memtables)
+
+    def update_memory_usage(self):
+        memory = self.get_memtable_memory()
+        if self.memory_usage is not None:
+            self.memory_usage[self.shard] = memory
+        return memory
+
+    def check_memory_budget(self):
+        """Flush when the memtables of the node take more than memtable_memory_budget bytes"""
+        memory = self.update_memory_usage()
+        if self.memtable_memory_budget <= 0:
+            return
+        node_memory, shards = memory, 1
+        if self.memory_usage is not None:
+            node_memory, shards = sum(self.memory_usage), len(self.memory_usage)
+        if node_memory <= self.memtable_memory_budget:
+            return
+
+        if self.frozen_memtables:
+            # wait for a flush of this storage to finish
+            self.flush_stats['budget_waits'] += 1
+            self.flush_frozen_memtable()
+        elif memory * shards >= node_memory:
+            # this storage holds at least its share of the memtable memory of the node
+            self.flush_stats['budget_flushes'] += 1
+            self.freeze_memtable()
+        self.update_memory_usage()
+
+    def flush_frozen_memtables(self):
+        while self.flush_frozen_memtable():
+            pass
+
+    def flush_to_file(self):
+        """Flush the active memtable and wait for all pending flushes"""
+        self.freeze_memtable()
+        self.flush_frozen_memtables()
+
+    def flush_task(self):
+        while not self.stopped.is_set():
+            self.flush_event.wait()
+            self.flush_event.clear()
+            try:
+                self.flush_frozen_memtables()
+            except Exception as e:
+                logging.error('%s | Error occurred during memtable flush: %s' % (self.label, e), exc_info=True)
+
+    def compact(self):
+        """Merge the SSTables chosen by the compaction strategy, returns False if there was nothing to compact.
+
+        Safe to run in a background thread: inputs are only read, the table list is swapped under sstables_lock and
+        the input files are left to release_obsolete_sstables.
+        """
+        tables = self.table_index_names
+        task = self.compaction_strategy.get_next_compaction([(name, self.sstable_metadata[name]) for name in tables])
+        if not task:
+            return False
+        inputs, level = task
+        inputs = sorted(inputs, key=self.get_sstable_age)
+
+        start = time.time()
+        with self.sstables_lock:
+            existing_names = tables + self.obsolete_sstables
+        max_sstable_size = self.compaction_strategy.max_sstable_size
+        outputs = {}
+        output = writer = None
+        rows = [iter_sstable(self.get_data_file_path(name), self.get_index_file_path(name),
+                             self.sstable_metadata[name].get('compression')) for name in inputs]
+        skipped = self.get_skipped_sstables(tables, inputs)
+        try:
+            for key, version, data in merge_sstables(rows):
+                if skipped and self.is_shadowed(key, version, skipped):
+                    continue
+                if writer is None:
+                    output = compacted_name(inputs[-1], existing_names + list(outputs))
+                    writer = self.get_sstable_writer(output, level)
+                writer.append(key, data, version)
+                if max_sstable_size is not None and writer.offset >= max_sstable_size:
+                    outputs[output] = writer.close()
+                    writer = None
+            if writer is not None:
+                outputs[output] = writer.close()
+        finally:
+            for _, _, index in skipped:
+                index.close()
+
+        with self.sstables_lock:
+            for output, (bloom_filter, metadata) in outputs.items():
+                self.bloom_filters[output] = bloom_filter
+                self.sstable_metadata[output] = metadata
+            # the manifest names the inputs until their files are removed, see remove_leftover_files
+            self.obsolete_sstables.extend(inputs)
+            self.set_sstables([name for name in self.table_index_names if name not in inputs] + list(outputs))
+            self.compaction_stats['compactions'] += 1
+            self.compaction_stats['compacted_sstables'] += len(inputs)
+
+        logging.info('%s | Compacted %d sstables (%s ... %s) into %d sstables of level %d in %.3fs'
+                     % (self.label, len(inputs), inputs[0], inputs[-1], len(outputs), level, time.time() - start))
+        return True
+
+    def get_skipped_sstables(self, tables, inputs):
+        """SSTables between the oldest and the newest input of a compaction (tables oldest first) that are not merged,
+        as (metadata, bloom filter, index reader opened for the compaction), newest first.
+
+        The output takes the place of the newest input, in front of them: a row of an older input must not go into it
+        when one of them holds a newer version of the key (see is_shadowed)."""
+        ordered = sorted(tables, key=self.get_sstable_age)
+        positions = [ordered.index(name) for name in inputs]
+        skipped = [name for name in ordered[min(positions):max(positions) + 1] if name not in inputs]
+        return [(self.sstable_metadata[name], self.bloom_filters[name],
+                 IndexReader(self.get_index_file_path(name), self.index_summary_interval,
+                             self.index_summaries.get(name)))
+                for name in reversed(skipped) if self.sstable_metadata[name]['entries']]
+
+    @staticmethod
+    def is_shadowed(key, version, skipped):
+        """Whether one of the skipped SSTables of a compaction holds a newer version of key than version"""
+        for metadata, bloom_filter, index in skipped:
+            if metadata['min_key'] <= key <= metadata['max_key'] and bloom_filter.might_contain(key):
+                entry = index.search(key)
+                if entry is not None:
+                    # versions of a key grow from older to newer SSTables, the newest skipped one holding key decides
+                    return entry[2] > version
+        return False
+
+    def release_obsolete_sstables(self):
+        """Close and remove the files of SSTables merged by compaction, must not run concurrently with reads"""
+        if not self.obsolete_sstables:
+            return
+        with self.sstables_lock:
+            obsolete, self.obsolete_sstables = self.obsolete_sstables, []
+        if self.key_cache is not None:
+            obsolete_names = set(obsolete)
+            self.key_cache.invalidate(lambda key, entry: entry[0] in obsolete_names)
+        for name in obsolete:
+            index = self.table_indices.pop(name)
+            if index is not None:
+                index.close()
+            self.index_summaries.pop(name, None)
+            data_file_map = self.data_file_maps.pop(name)
+            if data_file_map is not None:
+                data_file_map.close()
+            self.bloom_filters.pop(name, None)
+            compression = self.sstable_metadata.pop(name).get('compression')
+            if compression is not None:
+                for block in range(len(compression['block_offsets']) - 1):
+                    self.block_cache.pop((name, block))
+            for path in [self.get_index_file_path(name), self.get_bloom_filter_file_path(name),
+                         self.get_metadata_file_path(name), self.get_data_file_path(name)]:
+                os.remove(path)
+
+    def compaction_task(self):
+        while not self.stopped.is_set():
+            self.compaction_event.wait(self.compaction_interval)
+            self.compaction_event.clear()
+            try:
+                while self.compact():
+                    pass
+            except Exception as e:
+                logging.error('%s | Error occurred during compaction: %s' % (self.label, e), exc_info=True)
 
     def read_index_file(self, index_key):
-        index_file_path = self.get_index_file_path(index_key)
-        with open(index_file_path, 'r') as csv_file:
-            index = {}
-            csv_data = csv.reader(csv_file, delimiter=',')
-            for row in csv_data:
-                index[row[0]] = [int(row[1]), int(row[2]), int(row[3])]
-            self.table_indices.set(index_key, index)
-            return index
+        index = IndexReader(self.get_index_file_path(index_key), self.index_summary_interval,
+                            self.index_summaries.get(index_key))
+        self.index_summaries[index_key] = index.summary
+        self.table_indices.set(index_key, index)
+        return index
 
     def get_data_from_memtable(self, key):
-        d = self.memtable.get(key, None)
-        if d:
-            return [d, self.memversions[key]]
-        else:
-            return []
+        d = self.memtable.get(key)
+        if d is not None:
+            return d
+        for frozen in reversed(self.frozen_memtables):
+            d = frozen['memtable'].get(key)
+            if d is not None:
+                return d
+        return []
 
-    def get_data_from_sstables(self, key):
-        # TODO: find another policy
-        for index_key in sorted(self.table_index_names, reverse=True):
-            d = self.get_data_from_sstable(key, index_key)
+    def get_data_from_row_cache(self, key):
+        if self.row_cache is None:
+            return self.get_data_from_sstables(key)
+        d = self.row_cache.get(key)
+        if d is None:
+            d = self.get_data_from_sstables(key)
             if d:
-                return d
+                self.row_cache.set(key, d)
+        return d
+
+    @staticmethod
+    def get_row_size(key, row):
+        # bytes of the key and the value, a row is [data, version]
+        return len(key) + len(row[0])
+
+    def get_data_from_sstables(self, key):
+        self.read_amplification_stats['reads'] += 1
+        cached = self.get_from_key_cache(key)
+        if cached is not None:
+            self.read_amplification_stats['sstables'] += 1
+            index_key, (offset, length, version) = cached
+            return [self.read_data(index_key, offset, length), version]
+        for index_key in self.get_sstables_for_key(key):
+            self.read_amplification_stats['sstables'] += 1
+            ol = self.search_in_index(key, index_key)
+            if ol:
+                offset, length, version = ol
+                self.set_key_cache(key, index_key, offset, length, version)
+                return [self.read_data(index_key, offset, length), version]
         return []
 
-    def get_data_from_sstable(self, key, index_key):
-        ol = self.search_in_index(key, index_key)
-        if ol:
-            offset, length, version = ol
-            data_file_path = self.get_data_file_path(index_key)
-            with open(data_file_path, 'rb') as datafile:
-                datafile.seek(offset, 0)
-                data = datafile.read(length)
-                return [data.decode(), version]
-        else:
+    def get_from_key_cache(self, key):
+        """(index_key, [offset, length, version]) of the latest row of key, None if key is not in the key cache"""
+        if self.key_cache is None:
+            return None
+        entry = self.key_cache.get(key)
+        if entry is None:
             return None
+        return entry[0], list(entry[1:])
+
+    def set_key_cache(self, key, index_key, offset, length, version):
+        if self.key_cache is not None:
+            self.key_cache.set(key, (index_key, offset, length, version))
+
+    def read_data(self, index_key, offset, length):
+        if length == 0:
+            return b''
+        compression = self.sstable_metadata[index_key].get('compression')
+        if compression is not None:
+            block, offset_in_block = decode_block_offset(offset)
+            with memoryview(self.read_block(index_key, block, compression)) as data:
+                return bytes(data[offset_in_block:offset_in_block + length])
+        if self.mmap_data_files:
+            with memoryview(self.map_data_file(index_key)) as data_file_map:
+                with data_file_map[offset:offset + length] as data:
+                    return bytes(data)
+        data_file_path = self.get_data_file_path(index_key)
+        with open(data_file_path, 'rb') as datafile:
+            datafile.seek(offset, 0)
+            return datafile.read(length)
+
+    def scan(self, start_key=None, end_key=None, limit=None, page_token=None):
+        """One page of the rows from start_key (inclusive) to end_key (exclusive, None for no end) in key order.
+
+        A page holds at most limit rows (None or 0 for no limit) and at most max_scan_page_size bytes of rows (see
+        get_scan_row_size), but at least one row. Returns {'rows': [[key, data, version], ...], 'page_token': token},
+        the token is passed to the next scan to get the following page and is None after the last page.
+        """
+        try:
+            if page_token is not None:
+                start_key = page_token
+            rows = []
+            page_size = 0
+            next_key = None
+            for key, version, data in self.iter_range(start_key, end_key):
+                row = [key, data, version]
+                row_size = self.get_scan_row_size(row)
+                if rows and (page_size + row_size > self.max_scan_page_size or (limit and len(rows) >= limit)):
+                    # the page is full, the next one starts at this key
+                    next_key = key
+                    break
+                rows.append(row)
+                page_size = page_size + row_size
+            return True, {'rows': rows, 'page_token': next_key}
+
+        except Exception as e:
+            error_message = 'Error occurred when scan [%s, %s) in database: %s' % (start_key, end_key, e)
+            logging.error('%s | %s' % (self.label, error_message), exc_info=True)
+            return False, error_message
+
+    @staticmethod
+    def get_scan_row_size(row):
+        # encoded bytes of a [key, data, version] row in a response (see encode_payload): the JSON of the key (escaped,
+        # non-ascii characters as \uXXXX), the version and the marker of the data in the header, then the data itself
+        key, data, version = row
+        return len(json.dumps(key)) + len(data) + len(str(len(data))) + len(str(version)) + SCAN_ROW_FRAMING
+
+    def iter_range(self, start_key=None, end_key=None):
+        """Iterate (key, version, data) in key order over the latest rows from start_key to end_key (exclusive).
+
+        Rows are streamed from a k-way merge of the SSTables overlapping the range and the memtables, all of which
+        are sorted by key, so only one row per source is held in memory.
+        """
+        with self.sstables_lock:
+            names = self.table_index_names
+            frozen_memtables = self.frozen_memtables
+
+        sources = []
+        for name in names:
+            metadata = self.sstable_metadata[name]
+            if metadata['entries'] and (start_key is None or start_key <= metadata['max_key']) \
+                    and (end_key is None or metadata['min_key'] < end_key):
+                sources.append(self.iter_sstable_range(name, start_key, end_key))
+        for memtable in [frozen['memtable'] for frozen in frozen_memtables] + [self.memtable]:
+            sources.append((key, version, data) for key, data, version in memtable.items(start_key, end_key))
+        # sources are ordered oldest first
+        return merge_sstables(sources)
+
+    def iter_sstable_range(self, index_key, start_key, end_key):
+        # a scan interleaves the ranges of all its SSTables, more than table_indices keeps open: the range is read
+        # through its own index reader, which an eviction from table_indices cannot close
+        index = IndexReader(self.get_index_file_path(index_key), self.index_summary_interval,
+                            self.index_summaries.get(index_key))
+        self.index_summaries[index_key] = index.summary
+        try:
+            for key, offset, length, version in index.iter_from(start_key, end_key):
+                yield key, version, self.read_data(index_key, offset, length)
+        finally:
+            index.close()
+
+    def read_block(self, index_key, block, compression):
+        # decompressed block of a compressed SSTable
+        data = self.block_cache.get((index_key, block))
+        if data is None:
+            start, end = compression['block_offsets'][block], compression['block_offsets'][block + 1]
+            if self.mmap_data_files:
+                data = zlib.decompress(self.map_data_file(index_key)[start:end])
+            else:
+                with open(self.get_data_file_path(index_key), 'rb') as datafile:
+                    datafile.seek(start, 0)
+                    data = zlib.decompress(datafile.read(end - start))
+            self.block_cache.set((index_key, block), data)
+        return data
+
+    def map_data_file(self, index_key):
+        data_file_map = self.data_file_maps.get(index_key)
+        if data_file_map is None:
+            with open(self.get_data_file_path(index_key), 'rb') as datafile:
+                data_file_map = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data_file_maps.set(index_key, data_file_map)
+        return data_file_map
+
+    @staticmethod
+    def close_data_file_map(index_key, data_file_map):
+        data_file_map.close()
+
+    @staticmethod
+    def close_index(index_key, index):
+        index.close()
 
     def get_version(self, key):
-        if key in self.memversions:
-            return self.memversions[key]
+        version = self.memtable.get_version(key)
+        if version is not None:
+            return version
+        for frozen in reversed(self.frozen_memtables):
+            version = frozen['memtable'].get_version(key)
+            if version is not None:
+                return version
         d = self.search_in_indices(key)
         if d:
             return d[2]
         else:
             return 0
 
+    def get_versions(self, keys):
+        """{key: version} of several keys (0 for new keys), SSTables are searched together"""
+        versions = {}
+        missing = []
+        for key in set(keys):
+            version = self.memtable.get_version(key)
+            for frozen in reversed(self.frozen_memtables):
+                if version is not None:
+                    break
+                version = frozen['memtable'].get_version(key)
+            if version is None:
+                missing.append(key)
+            versions[key] = version or 0
+        for key, (_, d) in self.search_in_indices_many(missing).items():
+            versions[key] = d[2]
+        return versions
+
+    def search_in_indices_many(self, keys, count_reads=False):
+        """{key: (index_key, [offset, length, version])} of the newest SSTable holding each of keys.
+
+        Keys in the key cache are taken from it. The others are looked up in rounds, every round searches the next
+        candidate SSTable of every key still missing, grouped by SSTable and in key order. count_reads adds the
+        lookups to the read amplification stats.
+        """
+        found = {}
+        candidates = {}
+        for key in keys:
+            cached = self.get_from_key_cache(key)
+            if cached is not None:
+                found[key] = cached
+            else:
+                candidates[key] = self.get_sstables_for_key(key)
+        if count_reads:
+            self.read_amplification_stats['reads'] += len(keys)
+            self.read_amplification_stats['sstables'] += len(found)
+        while candidates:
+            groups = {}
+            for key, tables in candidates.items():
+                index_key = next(tables, None)
+                if index_key is not None:
+                    groups.setdefault(index_key, []).append((key, tables))
+            candidates = {}
+            for index_key, group in groups.items():
+                if count_reads:
+                    self.read_amplification_stats['sstables'] += len(group)
+                for key, tables in sorted(group, key=lambda candidate: candidate[0]):
+                    d = self.search_in_index(key, index_key)
+                    if d:
+                        found[key] = (index_key, d)
+                    else:
+                        candidates[key] = tables
+        return found
+
     def search_in_indices(self, key):
-        for index_key in sorted(self.table_index_names, reverse=True):
+        cached = self.get_from_key_cache(key)
+        if cached is not None:
+            return cached[1]
+        for index_key in self.get_sstables_for_key(key):
             d = self.search_in_index(key, index_key)
             if d:
                 return d
         return
 
     def search_in_index(self, key, index_key):
+        bloom_filter = self.bloom_filters.get(index_key)
+        if bloom_filter is not None:
+            if not bloom_filter.might_contain(key):
+                self.bloom_filter_stats['misses'] += 1
+                return None
+            self.bloom_filter_stats['hits'] += 1
+
         index = self.table_indices.get(index_key)
-        if not index:
+        if index is None:
             index = self.read_index_file(index_key)
-        return index.get(key, None)
+        d = index.search(key)
+        if d is None and bloom_filter is not None:
+            self.bloom_filter_stats['false_positives'] += 1
+        return d
+
+    def get_memtable_stats(self):
+        memtables = [self.memtable] + [frozen['memtable'] for frozen in self.frozen_memtables]
+        stats = {
+            'entries': sum(len(memtable) for memtable in memtables),
+            'data_size': sum(memtable.data_size for memtable in memtables),
+            'accounted_memory': sum(memtable.size for memtable in memtables),
+            'actual_memory': sum(memtable.measure_memory() for memtable in memtables),
+            'memory_budget': self.memtable_memory_budget,
+        }
+        if self.memory_usage is not None:
+            stats['node_accounted_memory'] = sum(self.memory_usage)
+        return stats
+
+    def get_index_summary_stats(self):
+        summaries = list(self.index_summaries.values())
+        return {
+            'interval': self.index_summary_interval,
+            'sstables': len(summaries),
+            'entries': sum(summary.count for summary in summaries),
+            'samples': sum(len(summary.keys) for summary in summaries),
+            'memory': sum(summary.measure_memory() for summary in summaries),
+        }
+
+    def get_stats(self):
+        levels = {}
+        for name in self.table_index_names:
+            level = self.sstable_metadata[name]['level']
+            levels[level] = levels.get(level, 0) + 1
+        reads = self.read_amplification_stats['reads']
+        return {
+            'sstables': len(self.table_index_names),
+            'memtable': self.get_memtable_stats(),
+            'pending_flushes': len(self.frozen_memtables),
+            'flush': dict(self.flush_stats),
+            'levels': levels,
+            'bloom_filter': dict(self.bloom_filter_stats),
+            'compaction': dict(self.compaction_stats),
+            'read_amplification': dict(self.read_amplification_stats,
+                                       average=self.read_amplification_stats['sstables'] / reads if reads else 0),
+            'row_cache': self.row_cache.get_stats() if self.row_cache is not None else None,
+            'key_cache': self.key_cache.get_stats() if self.key_cache is not None else None,
+            'index_summary': self.get_index_summary_stats(),
+            'block_cache': self.block_cache.get_stats(),
+        }
 
     def singal_handler(self, signal, frame):
         self.flush_to_file()
         logging.error('Storage: Stopping process with Pid(%s) signal(%s), frame(%s)' % (os.getpid(), signal, frame))
         sys.exit(0)
 
+    def start_background_tasks(self):
+        """Start the compaction, flush and (periodic) commit log sync threads"""
+        self.stopped.clear()
+        self.background_threads = [
+            threading.Thread(target=self.compaction_task, name='%s(Compaction)' % self.label, daemon=True),
+            threading.Thread(target=self.flush_task, name='%s(Flush)' % self.label, daemon=True),
+        ]
+        if self.commit_log.sync_mode == 'periodic':
+            self.background_threads.append(threading.Thread(target=self.commit_log.periodic_sync_task,
+                                                            args=(self.stopped,), name='%s(CommitLog)' % self.label,
+                                                            daemon=True))
+        for thread in self.background_threads:
+            thread.start()
+        self.background_flush = True
+
+    def stop_background_tasks(self):
+        """Stop the background threads, waiting for a running compaction or flush to finish"""
+        self.stopped.set()
+        self.compaction_event.set()
+        self.flush_event.set()
+        for thread in self.background_threads:
+            thread.join()
+        self.background_threads = []
+        self.background_flush = False
+
+    def sync_commit_log(self):
+        self.commit_log.sync()
+        for remote_identifier, msg_to_send in self.pending_responses:
+            self.manager.send_msg_object(remote_identifier, msg_to_send)
+        self.pending_responses = []
+
+    def get_msg_batch(self, msg):
+        """msg and the messages following it: up to request_batch_size messages, waiting at most request_batch_wait
+        (and never past a pending group commit)"""
+        msgs = [msg]
+        wait = self.request_batch_wait
+        sync_delay = self.commit_log.get_sync_delay() if self.pending_responses else None
+        if sync_delay is not None:
+            wait = min(wait, sync_delay)
+        deadline = time.time() + wait
+        while len(msgs) < self.request_batch_size:
+            timeout = deadline - time.time()
+            msg = self.manager.get_msg(timeout=timeout) if timeout > 0 else self.manager.get_msg(block=False)
+            if msg is None:
+                break
+            msgs.append(msg)
+        return msgs
+
+    def handle_request(self, request):
+        if request[0] == 'put':
+            status, description = self.put(request[1], request[2])
+        elif request[0] == 'get':
+            status, description = self.get(request[1])
+        elif request[0] == 'update':
+            status, description = self.update(request[1], request[2], request[3])
+        elif request[0] == 'scan':
+            status, description = self.scan(*request[1:])
+        elif request[0] == 'stats':
+            status, description = True, self.get_stats()
+        else:
+            description = 'Request can not be recognized: %s' % request
+            status = False
+            logging.error('%s | %s' % (self.label, description), exc_info=True)
+        return status, description
+
+    def handle_requests(self, requests):
+        """Handle requests in order, returns their (status, description). Consecutive puts and consecutive gets are
+        handled together (put_many, get_many)."""
+        results = []
+        for request_type, group in itertools.groupby(requests, key=lambda request: request[0]):
+            group = list(group)
+            if len(group) == 1 or request_type not in ['put', 'get']:
+                results.extend(self.handle_request(request) for request in group)
+            elif request_type == 'put':
+                results.extend([self.put_many([(request[1], request[2]) for request in group])] * len(group))
+            else:
+                status, description = self.get_many([request[1] for request in group])
+                if status:
+                    results.extend((True, description[request[1]]) for request in group)
+                else:
+                    results.extend([(status, description)] * len(group))
+        return results
+
     def run(self):
         logging.info('%s started - Pid: %ds' % (self.label, self.pid))
         signal.signal(signal.SIGINT, self.singal_handler)
+        self.start_background_tasks()
         while True:
-            msg = self.manager.get_msg()
-
-            remote_identifier = addr_tuple_to_str(msg['message'].source_addr)
+            self.release_obsolete_sstables()
 
-            values = msg['message'].get_values()
+            sync_delay = self.commit_log.get_sync_delay() if self.pending_responses else None
+            if self.pending_responses and (sync_delay is None or sync_delay <= 0):
+                # group window elapsed, or the writes were synced already (the commit log rolled on a freeze)
+                self.sync_commit_log()
+                continue
+            msg = self.manager.get_msg(timeout=sync_delay)
+            if msg is None:
+                # group window elapsed without new requests
+                self.sync_commit_log()
+                continue
 
-            if values['code'] == MESSAGE_CODE_REQUEST:
-                request = values['request']
-                request_hash = values['request_hash']
+            requests = []
+            for msg in self.get_msg_batch(msg):
+                values = msg['message'].get_values()
+                if values['code'] == MESSAGE_CODE_REQUEST:
+                    requests.append((addr_tuple_to_str(msg['message'].source_addr), values['request'],
+                                     values['request_hash'], msg.get('gather', False)))
+                else:
+                    logging.error('%s | Unsupported message type %s in message %s'
+                                  % (self.label, values['code'], str(values)))
 
-                if request[0] == 'put':
-                    status, description = self.put(request[1], request[2])
-                elif request[0] == 'get':
-                    status, description = self.get(request[1])
-                elif request[0] == 'update':
-                    status, description = self.update(request[1], request[2], request[3])
+            results = self.handle_requests([request for _, request, _, _ in requests])
+            for (remote_identifier, request, request_hash, gather), (status, description) in zip(requests, results):
+                if gather:
+                    # part of a request the dispatcher answers itself
+                    self.reply_queue.put((status, description))
+                    continue
+                msg_to_send = ResponseMessage(pack_response(status, description, request_hash),
+                                              self.manager.get_self_addr())
+                if request[0] in ['put', 'update'] and self.commit_log.sync_mode == 'group':
+                    self.pending_responses.append((remote_identifier, msg_to_send))
                 else:
-                    description = 'Request can not be recognized: %s' % request
-                    status = False
-                    logging.error('%s | %s' % (self.label, description), exc_info=True)
-
-                d = {'status': status, 'description': description, 'request_hash': request_hash}
-                s = bytes(json.dumps(d), 'ascii')
-                msg_to_send = ResponseMessage(s, self.manager.get_self_addr())
-                self.manager.send_msg_object(remote_identifier, msg_to_send)
-            else:
-                logging.error('%s | Unsupported message type %s in message %s'
-                              % (self.label, values['code'], str(values)))
+                    self.manager.send_msg_object(remote_identifier, msg_to_send)
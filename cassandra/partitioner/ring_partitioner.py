@@ -1,48 +1,101 @@
+import bisect
 import logging
 import mmh3
 import random
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Manager, Value
 
+try:
+    import numpy
+except ImportError:  # get_node_addrs_many bisects key by key
+    numpy = None
+
+from cassandra.partitioner.ring_snapshot import RingSnapshot, SnapshotPublisher, shared_memory
+from cassandra.partitioner.token_allocation import TOKEN_ALLOCATIONS, balanced_tokens
 from cassandra.util.message_codes import *
 
 
 class RingPartitioner(Process):
+    """Consistent hashing ring of the virtual nodes of all live physical nodes.
+
+    The partitioner process changes the ring when nodes join or leave; the ring is kept in Manager proxies (token2node,
+    node2token, phy2node, dht). After every change it publishes an immutable snapshot of the ring (sorted tokens and
+    the physical node of every token) to a shared memory block of the new ring version, then makes that version
+    current by setting ring_version, a counter in shared memory. Every process routes keys on its own snapshot with
+    bisect and swaps it for the snapshot of the current version when ring_version moves, so routing is O(log n) on
+    local memory, without calls to the manager process. Without multiprocessing.shared_memory (python < 3.8) the
+    snapshot is rebuilt from the proxies instead.
+
+    The replicas of a key are the first replica_num distinct physical nodes met walking the ring from the first vnode
+    after its token on. The snapshot holds them for every position of the ring, computed once per ring change, so
+    routing a key is one bisect and one table lookup.
+
+    token_allocation = hash gives every vnode the hash of its id as token; balanced allocates the tokens of the live
+    physical nodes one node after the other in the order of their ids, each node's vnodes where they even out the
+    ownership most given the tokens of the nodes before it (see token_allocation). The tokens depend on the membership
+    only, not on the order this process learned it in, so all nodes build the same ring. On a ring change only the
+    vnodes whose token changed are moved: those of the nodes whose id sorts after the joining or leaving node.
+
+    node may be None to use the ring without node messages (e.g. in benchmarks), the ring then starts empty.
+    """
+
     def __init__(self, node, config):
         super(RingPartitioner, self).__init__()
 
         self.identifier = 'partitioner'
         self.config = config
-        node.register(self.identifier, MESSAGE_CODE_NEW_LIVE_NODE)
-        node.register(self.identifier, MESSAGE_CODE_LOST_LIVE_NODE)
-        self.message_manager = node.get_manager(self.identifier)
+        self.message_manager = None
+        self.source_addr = None
+        if node is not None:
+            node.register(self.identifier, MESSAGE_CODE_NEW_LIVE_NODE)
+            node.register(self.identifier, MESSAGE_CODE_LOST_LIVE_NODE)
+            self.message_manager = node.get_manager(self.identifier)
+            self.source_addr = self.message_manager.get_self_addr()
 
-        self.source_addr = self.message_manager.get_self_addr()
-        self.v_node_num = int(self.config.get('vnode', '3'))
-        self.replica_num = int(self.config.get('replica', '1'))
+        self.v_node_num = int(self.config.get('v_node_num', self.config.get('vnode', '3')))
+        self.replica_num = int(self.config.get('replica_num', self.config.get('replica', '1')))
+        self.token_allocation = self.config.get('token_allocation', 'hash')
+        if self.token_allocation not in TOKEN_ALLOCATIONS:
+            raise ValueError('unknown token allocation %s, expected one of %s'
+                             % (self.token_allocation, ', '.join(TOKEN_ALLOCATIONS)))
         self.manager = Manager()
         self.token2node = self.manager.dict()
         self.phy2node = self.manager.dict()
         self.node2token = self.manager.dict()
         self.dht = self.manager.list()
+        self.ring_version = Value('q', 0)
+        self.snapshots = SnapshotPublisher('ring%08x' % random.getrandbits(32))
+        # ring of the partitioner process: sorted tokens and their virtual nodes
+        self.tokens = []
+        self.local_token2node = {}
+        # snapshot this process routes on
+        self.snapshot = RingSnapshot.from_ring(0, [], [], self.replica_num)
         self.u_bound = -(2 ** 31)
         self.l_bound = (2 ** 31) - 1
         self.partition_key = 0
-        self.new_physical_node(str(self.source_addr[0]) + ':' + str(self.source_addr[1]))
+        if self.source_addr is not None:
+            self.new_physical_node(str(self.source_addr[0]) + ':' + str(self.source_addr[1]))
 
     def run(self):
         handlers = {
             MESSAGE_CODE_NEW_LIVE_NODE: self.new_physical_node,
             MESSAGE_CODE_LOST_LIVE_NODE: self.delete_physical_node,
         }
-        while True:
-            msg = self.message_manager.get_msg()
-            msg_body = msg['message'].get_values()
-            logging.debug('partitioner msg: %s' % msg)
-            logging.debug('partitioner msg body: %s' % msg_body)
-            phy_id = msg_body['source']
-            handlers[msg['type']](phy_id)
-            logging.debug('partitioner after message: %s - %s - %s - %s - %s'
-                          % (phy_id, self.dht, self.phy2node, self.node2token, self.token2node))
+        try:
+            while True:
+                msg = self.message_manager.get_msg()
+                msg_body = msg['message'].get_values()
+                logging.debug('partitioner msg: %s' % msg)
+                logging.debug('partitioner msg body: %s' % msg_body)
+                phy_id = msg_body['source']
+                handlers[msg['type']](phy_id)
+                logging.debug('partitioner after message: %s - %s - %s - %s - %s'
+                              % (phy_id, self.dht, self.phy2node, self.node2token, self.token2node))
+        finally:
+            self.close()
+
+    def close(self):
+        """Unlink the ring snapshots published by this process"""
+        self.snapshots.close()
 
     def set_partition_key(self, index):
         self.partition_key = index
@@ -72,14 +125,14 @@ class RingPartitioner(Process):
                               % (phy_id, self.dht, self.phy2node, self.node2token, self.token2node))
                 raise KeyError('physical node already registered')
             else:
-                self.phy2node[phy_id] = ([], 0)
-                v_list = []
-
-                for i in range(0, self.v_node_num):
-                    v_id = str(phy_id) + '$' + str(i)
-                    v_list.append(v_id)
-                    self.new_node(v_id)
+                v_list = [str(phy_id) + '$' + str(i) for i in range(0, self.v_node_num)]
                 self.phy2node[phy_id] = (v_list, self.v_node_num)
+                if self.token_allocation == 'balanced':
+                    self.allocate_balanced_tokens()
+                else:
+                    for v_id in v_list:
+                        self.new_node(v_id, self.get_node_token(v_id))
+                self.publish_ring()
 
         except Exception as e:
             logging.error('partitioner error: %s (%s) error occurred - %s' % (self.dht, self.node2token, e), exc_info=True)
@@ -92,16 +145,32 @@ class RingPartitioner(Process):
                 v_list, ver = self.phy2node[phy_id]
                 v_id = str(phy_id) + '$' + str(ver)
                 ver += 1
-                self.new_node(v_id)
                 v_list.append(v_id)
                 self.phy2node[phy_id] = (v_list, ver)
+                if self.token_allocation == 'balanced':
+                    self.allocate_balanced_tokens()
+                else:
+                    self.new_node(v_id, self.get_node_token(v_id))
+                self.publish_ring()
         except Exception as e:
             logging.error('partitioner error: %s (%s) error occurred - %s' % (self.dht, self.node2token, e), exc_info=True)
 
-    def new_node(self, v_id):
-        token = self.get_node_token(v_id)
+    def allocate_balanced_tokens(self):
+        """Give the vnodes of the live physical nodes (phy2node) their tokens of balanced allocation, moving only the
+        vnodes whose token changed"""
+        v_lists = {phy_id: v_list for phy_id, (v_list, _) in self.phy2node.items()}
+        v_tokens = balanced_tokens(v_lists)
+        for v_id, token in list(self.node2token.items()):
+            if v_tokens.get(v_id) != token:
+                self.delete_node(v_id)
+        for v_id, token in v_tokens.items():
+            if v_id not in self.node2token:
+                self.new_node(v_id, token)
+
+    def new_node(self, v_id, token):
         self.token2node[token] = v_id
         self.node2token[v_id] = token
+        self.local_token2node[token] = v_id
         self.token_insertion(token)
 
     def delete_physical_node(self, phy_id):
@@ -113,6 +182,9 @@ class RingPartitioner(Process):
             for i in range(0, size):
                 v_id = v_list[i]
                 self.delete_node(v_id)
+            if self.token_allocation == 'balanced':
+                self.allocate_balanced_tokens()
+            self.publish_ring()
         logging.error('partitioner: %s - %s - %s - %s - %s'
                       % (phy_id, self.dht, self.phy2node, self.node2token, self.token2node))
 
@@ -127,6 +199,9 @@ class RingPartitioner(Process):
                 v_id = v_list.pop()
                 self.delete_node(v_id)
                 self.phy2node[phy_id] = (v_list, ver)
+                if self.token_allocation == 'balanced':
+                    self.allocate_balanced_tokens()
+                self.publish_ring()
         except Exception as e:
             logging.error('partitioner error: %s (%s) error occurred - %s' % (self.dht, self.node2token, e), exc_info=True)
 
@@ -136,61 +211,105 @@ class RingPartitioner(Process):
         else:
             token = self.node2token.pop(v_id)
             self.token2node.pop(token)
+            self.local_token2node.pop(token, None)
             self.token_deletion(token)
 
     def token_deletion(self, token):
         try:
-            self.dht.remove(token)
-            if len(self.dht) <= 0:
+            i = bisect.bisect_left(self.tokens, token)
+            if i < len(self.tokens) and self.tokens[i] == token:
+                del self.tokens[i]
+            if len(self.tokens) <= 0:
                 self.u_bound = -(2 ** 63)
                 self.l_bound = 2 ^ 31 - 1
             else:
-                self.u_bound = self.dht[-1]
-                self.l_bound = self.dht[0]
+                self.u_bound = self.tokens[-1]
+                self.l_bound = self.tokens[0]
 
         except Exception as e:
-            logging.error('partitioner error: %s (%s) error occurred %s' % (self.dht, self.node2token, e), exc_info=True)
+            logging.error('partitioner error: %s (%s) error occurred %s' % (self.tokens, self.node2token, e),
+                          exc_info=True)
 
     def token_insertion(self, new_token):
-        size = len(self.dht)
+        bisect.insort(self.tokens, new_token)
+        self.u_bound = self.tokens[-1]
+        if self.l_bound > new_token:
+            self.l_bound = new_token
 
-        for i in range(0, size):
-            if self.dht[i] > new_token:
-                self.dht.insert(i, new_token)
+    def publish_ring(self):
+        """Share the changed ring of this process with the others: publish its snapshot, then make it current"""
+        self.dht[:] = self.tokens
+        owners = [self.local_token2node[token].split('$')[0] for token in self.tokens]
+        with self.ring_version.get_lock():
+            snapshot = RingSnapshot.from_ring(self.ring_version.value + 1, self.tokens, owners, self.replica_num)
+            if shared_memory is not None:
+                self.snapshots.publish(snapshot)
+            self.ring_version.value = snapshot.version
+        self.snapshot = snapshot
+
+    def refresh_ring(self):
+        """Swap the snapshot of this process for the current one if another process changed the ring"""
+        version = self.ring_version.value
+        while version != self.snapshot.version:
+            snapshot = self.snapshots.read(version) if shared_memory is not None else self.read_proxies(version)
+            if snapshot is not None:
+                self.snapshot = snapshot
+            elif version == self.ring_version.value:
+                # the snapshots were unlinked on shutdown of the partitioner, keep routing on the last one
                 break
-            else:
-                continue
-        else:
-            self.dht.append(new_token)
-            self.u_bound = new_token
+            version = self.ring_version.value
 
-        if self.l_bound > new_token:
-            self.l_bound = new_token
+    def read_proxies(self, version):
+        """Snapshot of the ring in the manager proxies"""
+        tokens = list(self.dht)
+        token2node = self.token2node.copy()
+        # tokens the partitioner is removing right now are skipped, the next version brings the ring up to date
+        tokens = [token for token in tokens if token in token2node]
+        owners = [token2node[token].split('$')[0] for token in tokens]
+        return RingSnapshot.from_ring(version, tokens, owners, self.replica_num)
 
     def find_replicas(self, key):
         try:
+            self.refresh_ring()
+            snapshot = self.snapshot
             row_token = self.get_token(key)
-            size = len(self.dht)
+            size = len(snapshot)
             if size <= 0:
                 raise KeyError('length error of dht: dht size is zero')
 
-            pos = 0
-            for i in range(0, size):
-                if self.dht[i] > row_token:
-                    pos = i
-                    break
-            dst_addrs = set()
-
-            for j in range(0, self.replica_num):
-                index = (pos + j) % size
-                v_id = self.token2node[self.dht[index]]
-                dst_addr = v_id.split('$')[0]
-                dst_addrs.add(dst_addr)
-            #logging.error('find replica: dht %s \ node2token %s \ row_token %s \ dst_addr %s' % (self.dht, self.node2token, row_token, dst_addr))
-
-            return list(dst_addrs)
+            # first vnode with a token greater than the row token, wrapping around the ring
+            pos = bisect.bisect_right(snapshot.tokens, row_token) % size
+            return list(snapshot.replicas[pos])
         except Exception as e:
-            logging.error('find replica error: %s (%s) error occurred - %s' % (self.dht, self.node2token, e), exc_info=True)
+            logging.error('find replica error: ring version %d (%d tokens) error occurred - %s'
+                          % (self.snapshot.version, len(self.snapshot), e), exc_info=True)
+
+    def find_replicas_many(self, keys):
+        """Replicas of many keys: {tuple of physical nodes: [keys]}
+
+        The keys are hashed in one pass and located on the ring with one numpy.searchsorted over the token array of
+        the snapshot."""
+        self.refresh_ring()
+        snapshot = self.snapshot
+        size = len(snapshot)
+        if size <= 0:
+            raise KeyError('length error of dht: dht size is zero')
+
+        keys = list(keys)
+        hash_key = mmh3.hash
+        row_tokens = [hash_key(str(key)) for key in keys]
+        if numpy is not None:
+            ring_tokens = numpy.frombuffer(snapshot.tokens, dtype=numpy.int64)
+            positions = (numpy.searchsorted(ring_tokens, numpy.array(row_tokens, dtype=numpy.int64), side='right')
+                         % size).tolist()
+        else:
+            positions = [bisect.bisect_right(snapshot.tokens, row_token) % size for row_token in row_tokens]
+
+        replicas = snapshot.replicas
+        groups = {}
+        for key, pos in zip(keys, positions):
+            groups.setdefault(replicas[pos], []).append(key)
+        return groups
 
     def get_node_addrs(self, key):
         try:
@@ -200,3 +319,16 @@ class RingPartitioner(Process):
 
         except Exception as e:
             logging.error('partitioner error: %s (%s) error occurred - %s' % (self.dht, self.node2token, e))
+
+    def get_node_addrs_many(self, keys):
+        """Route many keys at once, e.g. for bulk loads: {tuple of node addresses: [keys]}, so one message per replica
+        set can carry all its keys"""
+        try:
+            groups = self.find_replicas_many(keys)
+            logging.debug('partitioner: %d data keys route to %d replica sets' % (sum(map(len, groups.values())),
+                                                                                  len(groups)))
+            return groups
+
+        except Exception as e:
+            logging.error('partitioner error: ring version %d (%d tokens) error occurred - %s'
+                          % (self.snapshot.version, len(self.snapshot), e), exc_info=True)
@@ -0,0 +1,146 @@
+import json
+import logging
+import struct
+from array import array
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8, rings are shared through the manager proxies only
+    shared_memory = None
+
+# version, number of tokens, replicas per token, length of the json encoded owner names
+SNAPSHOT_HEADER = struct.Struct('<qqqq')
+# snapshots kept in shared memory, the older ones are unlinked: a reader that read the ring version just before a
+# change can still attach the snapshot of that version
+SNAPSHOTS_KEPT = 2
+
+
+def walk_replicas(owner_ids, replica_num):
+    """Replica table of a ring: for every position the owners of the first replica_num distinct physical nodes met
+    walking the ring from it on (all nodes if there are fewer), flattened into rows of width entries"""
+    size = len(owner_ids)
+    width = min(replica_num, len(set(owner_ids)))
+    replica_ids = array('I')
+    for pos in range(0, size):
+        replicas = []
+        j = pos
+        while len(replicas) < width:
+            owner = owner_ids[j % size]
+            if owner not in replicas:
+                replicas.append(owner)
+            j = j + 1
+        replica_ids.extend(replicas)
+    return replica_ids, width
+
+
+class RingSnapshot:
+    """Immutable version of the ring: sorted tokens, the physical node owning every token and the replicas of every
+    position of the ring, computed once per ring change by the partitioner.
+
+    In shared memory a snapshot is the header, the tokens (int64), the index of the owner of every token (uint32), the
+    replica table (width owner indices per token, uint32) and the json list of owner names, all in native byte order.
+    replicas[pos] is the sorted tuple of the physical nodes storing the keys routed to position pos.
+    """
+
+    def __init__(self, version, tokens, owner_ids, owner_names, replica_ids, width):
+        self.version = version
+        self.tokens = tokens
+        self.owner_ids = owner_ids
+        self.owner_names = owner_names
+        self.replica_ids = replica_ids
+        self.width = width
+        self.owners = [owner_names[i] for i in owner_ids]
+        # positions with the same replicas share one tuple
+        replica_sets = {}
+        rows = zip(*[iter(replica_ids)] * width) if width else []
+        for ids in set(rows):
+            replica_sets[ids] = tuple(sorted(owner_names[i] for i in ids))
+        rows = zip(*[iter(replica_ids)] * width) if width else []
+        self.replicas = [replica_sets[ids] for ids in rows]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @classmethod
+    def from_ring(cls, version, tokens, owners, replica_num):
+        """Snapshot of sorted tokens and the owner of every token, with replica_num replicas per position"""
+        owner_index = {}
+        owner_ids = array('I', [owner_index.setdefault(owner, len(owner_index)) for owner in owners])
+        replica_ids, width = walk_replicas(owner_ids, replica_num)
+        return cls(version, array('q', tokens), owner_ids, list(owner_index), replica_ids, width)
+
+    def encode(self):
+        names = bytes(json.dumps(self.owner_names), 'utf-8')
+        return b''.join([SNAPSHOT_HEADER.pack(self.version, len(self.tokens), self.width, len(names)),
+                         self.tokens.tobytes(), self.owner_ids.tobytes(), self.replica_ids.tobytes(), names])
+
+    @classmethod
+    def decode(cls, buf):
+        version, size, width, names_length = SNAPSHOT_HEADER.unpack_from(buf)
+        offset = SNAPSHOT_HEADER.size
+        tokens = array('q')
+        tokens.frombytes(buf[offset:offset + size * tokens.itemsize])
+        offset = offset + size * tokens.itemsize
+        owner_ids = array('I')
+        owner_ids.frombytes(buf[offset:offset + size * owner_ids.itemsize])
+        offset = offset + size * owner_ids.itemsize
+        replica_ids = array('I')
+        replica_ids.frombytes(buf[offset:offset + size * width * replica_ids.itemsize])
+        offset = offset + size * width * replica_ids.itemsize
+        owner_names = json.loads(str(bytes(buf[offset:offset + names_length]), 'utf-8'))
+        return cls(version, tokens, owner_ids, owner_names, replica_ids, width)
+
+
+class SnapshotPublisher:
+    """Writes the snapshots of one ring to shared memory blocks named <prefix>_<version>"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.blocks = []
+
+    def block_name(self, version):
+        return '%s_%d' % (self.prefix, version)
+
+    def publish(self, snapshot):
+        """Write snapshot to a new block, the caller then makes its version the current one"""
+        data = snapshot.encode()
+        block = shared_memory.SharedMemory(name=self.block_name(snapshot.version), create=True, size=len(data))
+        block.buf[:len(data)] = data
+        self.blocks.append(block)
+        while len(self.blocks) > SNAPSHOTS_KEPT:
+            self.release(self.blocks.pop(0))
+
+    def read(self, version):
+        """Snapshot of version, None if its block was already unlinked (a newer version was published meanwhile)"""
+        try:
+            block = self.attach(self.block_name(version))
+        except FileNotFoundError:
+            return None
+        try:
+            return RingSnapshot.decode(block.buf)
+        finally:
+            block.close()
+
+    @staticmethod
+    def attach(name):
+        # the block belongs to the publisher: untracked where possible (python 3.13+), otherwise the resource tracker
+        # shared with the publisher process already knows it
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            return shared_memory.SharedMemory(name=name)
+
+    @staticmethod
+    def release(block):
+        try:
+            block.close()
+            block.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error('partitioner error: releasing ring snapshot %s - %s' % (block.name, e), exc_info=True)
+
+    def close(self):
+        """Unlink all blocks published by this process"""
+        while self.blocks:
+            self.release(self.blocks.pop(0))
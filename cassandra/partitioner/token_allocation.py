@@ -0,0 +1,150 @@
+"""Token allocation of virtual nodes and an offline simulator of the ownership it gives.
+
+hash:       the token of a virtual node is the hash of its id (phy_id$i), as RingPartitioner.get_node_token
+balanced:   the physical nodes are placed one after the other in the order of their ids (see balanced_tokens): the
+            vnodes of the first node are spread evenly, those of every next node split the ranges that lower the
+            variance of ownership most, given the tokens of the nodes before it (see allocate_tokens). The ring
+            depends on the membership only, so every node computes the same one. A join or leave keeps the tokens of
+            the nodes whose ids sort before the node joining or leaving.
+
+    python -m cassandra.partitioner.token_allocation [-n nodes] [-v vnodes ...] [-r replica_num]
+"""
+import heapq
+import statistics
+from argparse import ArgumentParser
+
+import mmh3
+
+from cassandra.partitioner.ring_snapshot import RingSnapshot
+
+TOKEN_ALLOCATIONS = ('hash', 'balanced')
+RING_SIZE = 2 ** 32
+MIN_TOKEN = -(2 ** 31)
+
+
+def wrap_token(token):
+    return (token - MIN_TOKEN) % RING_SIZE + MIN_TOKEN
+
+
+def range_lengths(tokens):
+    """Length of the range owned by every token of a sorted ring: from the previous token (included) to it"""
+    if len(tokens) == 1:
+        return [RING_SIZE]
+    return [(tokens[i] - tokens[i - 1]) % RING_SIZE for i in range(0, len(tokens))]
+
+
+def hash_tokens(v_lists):
+    """{v_id: token} of the vnodes of all physical nodes ({phy_id: [v_id]}) with hash allocation"""
+    return {v_id: mmh3.hash(v_id) for v_ids in v_lists.values() for v_id in v_ids}
+
+
+def balanced_tokens(v_lists):
+    """{v_id: token} of the vnodes of all physical nodes ({phy_id: [v_id]}) with balanced allocation, the nodes
+    joining one after the other in the order of their ids"""
+    ring = {}
+    v_tokens = {}
+    for phy_id in sorted(v_lists):
+        v_ids = v_lists[phy_id]
+        v_tokens.update(zip(v_ids, allocate_tokens(ring, phy_id, len(v_ids))))
+    return v_tokens
+
+
+def allocate_tokens(ring, node, count):
+    """Add count tokens of node to ring ({token: node}), returns them.
+
+    Every node should own a share of the ring proportional to its number of tokens. A new token taken in the range
+    of a token of owner a moves the part x of the range before it from a to node, which lowers the sum of squared
+    deviations from those shares by 2x(dev[a] - dev[node] - x), most for x = (dev[a] - dev[node]) / 2. Every new token
+    takes the x, limited to the share node still lacks per token left to place, of the owner where that drop is
+    largest; the largest range of an owner is its best candidate.
+    """
+    if not ring:
+        start = mmh3.hash(node)
+        tokens = [wrap_token(start + i * RING_SIZE // count) for i in range(0, count)]
+        ring.update((token, node) for token in tokens)
+        return tokens
+
+    sorted_tokens = sorted(ring)
+    own = {node: 0}
+    weight = {node: count}
+    heaps = {node: []}
+    for token, length in zip(sorted_tokens, range_lengths(sorted_tokens)):
+        owner = ring[token]
+        own[owner] = own.get(owner, 0) + length
+        weight[owner] = weight.get(owner, 0) + 1
+        heaps.setdefault(owner, []).append((-length, token))
+    for heap in heaps.values():
+        heapq.heapify(heap)
+    total_weight = sum(weight.values())
+    share = {owner: RING_SIZE * w / total_weight for owner, w in weight.items()}
+
+    tokens = []
+    for i in range(0, count):
+        lacking = (share[node] - own[node]) / (count - i)
+        node_dev = own[node] - share[node]
+        best = None
+        for owner in sorted(heaps):
+            if owner == node or not heaps[owner]:
+                continue
+            dev = own[owner] - share[owner]
+            x = int(min(lacking, (dev - node_dev) / 2, -heaps[owner][0][0] - 1))
+            if x > 0 and (best is None or x * (dev - node_dev - x) > best[0]):
+                best = (x * (dev - node_dev - x), owner, x)
+        if best is None:
+            # node already owns its share: halve the largest range of the ring
+            owner = min(heaps, key=lambda o: (heaps[o][0] if heaps[o] else (0, 0), o))
+            best = (0, owner, -heaps[owner][0][0] // 2)
+        _, owner, x = best
+        neg_length, end = heapq.heappop(heaps[owner])
+        token = wrap_token(end + neg_length + x)
+        heapq.heappush(heaps[owner], (neg_length + x, end))
+        heapq.heappush(heaps[node], (-x, token))
+        own[owner] = own[owner] - x
+        own[node] = own[node] + x
+        ring[token] = node
+        tokens.append(token)
+    return tokens
+
+
+def ownership(v_tokens, replica_num=1):
+    """Share of the ring stored by every physical node ({v_id: token}, v_id = phy_id$i), counting replica_num
+    replicas as RingPartitioner places them"""
+    token2node = {token: v_id.split('$')[0] for v_id, token in v_tokens.items()}
+    tokens = sorted(token2node)
+    snapshot = RingSnapshot.from_ring(0, tokens, [token2node[token] for token in tokens], replica_num)
+    shares = {node: 0 for node in token2node.values()}
+    for replicas, length in zip(snapshot.replicas, range_lengths(tokens)):
+        for node in replicas:
+            shares[node] = shares[node] + length / RING_SIZE
+    return shares
+
+
+def simulate(nodes, v_node_num, allocation, replica_num=1):
+    """Ownership spread of nodes physical nodes of v_node_num vnodes: (min, max, stdev) in % of the mean"""
+    v_lists = {'10.0.0.%d:7000' % (i + 1): ['10.0.0.%d:7000$%d' % (i + 1, j) for j in range(0, v_node_num)]
+               for i in range(0, nodes)}
+    v_tokens = balanced_tokens(v_lists) if allocation == 'balanced' else hash_tokens(v_lists)
+    shares = list(ownership(v_tokens, replica_num).values())
+    mean = statistics.mean(shares)
+    stdev = statistics.pstdev(shares)
+    return min(shares) / mean * 100, max(shares) / mean * 100, stdev / mean * 100
+
+
+def main(nodes=3, vnode_counts=(1, 2, 3, 4, 8, 16, 64, 256), replica_num=1):
+    print('%d nodes, replica_num %d: ownership of the least and most loaded node and its stdev, %% of the mean'
+          % (nodes, replica_num))
+    print('%6s  %-24s  %-24s' % ('vnodes', 'hash min/max/stdev', 'balanced min/max/stdev'))
+    for v_node_num in vnode_counts:
+        spreads = ['%5.1f / %5.1f / %5.1f' % simulate(nodes, v_node_num, allocation, replica_num)
+                   for allocation in TOKEN_ALLOCATIONS]
+        print('%6d  %-24s  %-24s' % (v_node_num, spreads[0], spreads[1]))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--nodes', help='number of physical nodes', type=int, default=3)
+    parser.add_argument('-v', '--vnodes', help='virtual nodes per physical node', type=int, nargs='+',
+                        default=[1, 2, 3, 4, 8, 16, 64, 256])
+    parser.add_argument('-r', '--replica-num', help='replicas per key', type=int, default=1)
+    args = parser.parse_args()
+    main(args.nodes, args.vnodes, args.replica_num)
@@ -1,11 +1,10 @@
-import json
 import logging
-import mmh3
 import time
 from multiprocessing import Process
 
-from cassandra.util.message import RequestMessage, ResponseMessage
+from cassandra.util.message import RequestMessage, ResponseMessage, hash_request, pack_request, pack_response
 from cassandra.util.message_codes import MESSAGE_CODE_REQUEST
+from cassandra.util.packing import addr_tuple_to_str
 from cassandra.util.queue_item_types import QUEUE_ITEM_TYPE_RECEIVED_MESSAGE, QUEUE_ITEM_TYPE_SEND_MESSAGE
 
 
@@ -37,6 +36,7 @@ class CassandraController(Process):
         1. [get key]: get value of key.
         2. [put key value]: put (key, value) to database.
         3. [set key value]: set configuration of key to value.
+        4. [stats]: storage statistics of this node.
         """
         try:
             logging.info('%s | start - Pid: %s' % (self.label, self.pid))
@@ -58,16 +58,16 @@ class CassandraController(Process):
                     logging.info('%s | processing commands: %s from %s' % (self.label, request_hash, client_addr))
 
                     status, resp = False, None
-                    if request[0] in ['get', 'put']:
-                        key = request[1]
-
-                        hash1 = mmh3.hash(json.dumps((client_addr, request)))
+                    if request[0] in ['get', 'put', 'stats']:
+                        hash1 = hash_request(client_addr, request)
                         assert hash1 == request_hash, 'Request hash %s != %s' % (request_hash, hash1)
 
-                        # send request to nodes
-                        s = json.dumps({'request': request, 'request_hash': request_hash})
-                        msg = RequestMessage(bytes(s, 'ascii'), self.manager.get_self_addr())
-                        dst_addrs = self.partitioner.get_node_addrs(key)
+                        # send request to nodes, values are passed on as they were received
+                        msg = RequestMessage(pack_request(request, request_hash), self.manager.get_self_addr())
+                        if request[0] == 'stats':
+                            dst_addrs = [addr_tuple_to_str(self.manager.get_self_addr())]
+                        else:
+                            dst_addrs = self.partitioner.get_node_addrs(request[1])
                         for addr in dst_addrs:
                             self.manager.send_msg_object(addr, msg)
 
@@ -90,9 +90,7 @@ class CassandraController(Process):
                         logging.error('%s | %s' % (self.label, resp))
 
                     if resp is not None:
-                        d = {'status': status, 'description': resp, 'request_hash': request_hash}
-                        s = bytes(json.dumps(d), 'ascii')
-                        msg_to_send = ResponseMessage(s, server_addr)
+                        msg_to_send = ResponseMessage(pack_response(status, resp, request_hash), server_addr)
 
                         self.sender_queue.put({
                             'type': QUEUE_ITEM_TYPE_SEND_MESSAGE,
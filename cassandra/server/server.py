@@ -152,7 +152,8 @@ class CassandraServer(Scheduler):
             exit(1)
 
     def can_response(self, responses):
-        str_to_threshold = {'any': 1, 'all': self.partitioner.v_node_num}
+        # 'all': every replica the request was sent to
+        str_to_threshold = {'any': 1, 'all': len(responses)}
         protocol = self.config['response_protocol']
         threshold = str_to_threshold[protocol] if isinstance(protocol, str) else protocol
 
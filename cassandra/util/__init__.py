@@ -1,5 +1,29 @@
+import os
+
+
+def str_to_bool(s):
+    return str(s).strip().lower() in ('true', 'yes', 'on', '1')
+
+
 def int_or_str(s):
     try:
         return int(s)
     except ValueError:
         return s
+
+
+def fsync_file(f):
+    """Flush an open file to disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def fsync_dir(dir_path):
+    """Flush a directory to disk, so files created, renamed or removed in it stay so after a crash (posix only)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(dir_path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
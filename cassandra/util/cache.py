@@ -1,3 +1,6 @@
+from collections import OrderedDict
+
+
 class BasicCache:
     """Base class of all kinds of caches."""
 
@@ -12,26 +15,109 @@ class BasicCache:
 
 
 class LRUCache(BasicCache):
-    """Cache using Least Recently Used (LRU) algorithm"""
+    """Cache using Least Recently Used (LRU) algorithm
 
-    def __init__(self, capacity):
+    on_evict(key, value) is called for entries evicted to make room for new ones.
+    """
+
+    def __init__(self, capacity, on_evict=None):
         super(LRUCache, self).__init__(capacity)
-        self.cache = {}
-        self.used_list = []
+        # least recently used first
+        self.cache = OrderedDict()
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
 
     def set(self, key, value):
         if key in self.cache:
-            self.used_list.remove(key)
+            self.cache.move_to_end(key)
         elif 0 < self.capacity == len(self.cache):
-            self.cache.pop(self.used_list.pop(0))
-        self.used_list.append(key)
+            self.evict()
         self.cache[key] = value
 
+    def evict(self):
+        evicted_key, evicted_value = self.cache.popitem(last=False)
+        if self.on_evict is not None:
+            self.on_evict(evicted_key, evicted_value)
+        return evicted_key, evicted_value
+
     def get(self, key):
         if key in self.cache:
-            if not key == self.used_list[-1]:
-                self.used_list.remove(key)
-                self.used_list.append(key)
+            self.hits = self.hits + 1
+            self.cache.move_to_end(key)
             return self.cache[key]
         else:
+            self.misses = self.misses + 1
             return None
+
+    def pop(self, key):
+        return self.cache.pop(key, None)
+
+    def invalidate(self, predicate):
+        """Remove the entries for which predicate(key, value) is true, returns their number"""
+        keys = [key for key, value in self.cache.items() if predicate(key, value)]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.cache),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+
+class SizedLRUCache(LRUCache):
+    """LRU cache bounded by the total size of its entries instead of their number
+
+    sizeof(key, value) returns the size of an entry (e.g. in bytes), least recently used entries are evicted until the
+    new one fits. Entries larger than the whole capacity are not cached.
+    """
+
+    def __init__(self, capacity, sizeof, on_evict=None):
+        super(SizedLRUCache, self).__init__(capacity, on_evict)
+        self.sizeof = sizeof
+        self.sizes = {}
+        self.size = 0
+
+    def set(self, key, value):
+        self.pop(key)
+        size = self.sizeof(key, value)
+        if 0 < self.capacity < size:
+            return
+        while 0 < self.capacity < self.size + size:
+            self.evict()
+        self.cache[key] = value
+        self.sizes[key] = size
+        self.size = self.size + size
+
+    def evict(self):
+        evicted_key, evicted_value = super(SizedLRUCache, self).evict()
+        self.size = self.size - self.sizes.pop(evicted_key)
+        return evicted_key, evicted_value
+
+    def pop(self, key):
+        if key in self.cache:
+            self.size = self.size - self.sizes.pop(key)
+        return super(SizedLRUCache, self).pop(key)
+
+    def clear(self):
+        super(SizedLRUCache, self).clear()
+        self.sizes.clear()
+        self.size = 0
+
+    def get_stats(self):
+        return dict(super(SizedLRUCache, self).get_stats(), size=self.size)
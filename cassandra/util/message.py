@@ -1,8 +1,66 @@
 import struct
 import json
+
+import mmh3
+
 from cassandra.util.packing import short_to_bytes, bytes_to_short, addr_to_bytes
 from cassandra.util.message_codes import *
 
+_PAYLOAD_HEADER = struct.Struct('>I')   # length of the JSON header
+BYTES_MARKER = '__bytes__'
+
+
+def encode_payload(values):
+    """Binary-safe encoding of JSON-compatible values which may contain bytes (e.g. stored values)
+
+    Format: header length (I) | JSON header (utf-8) | bytes objects. Every bytes object is replaced by
+    {"__bytes__": length} in the header and appended raw after it, so values are neither transcoded nor escaped.
+    Dicts whose only key is "__bytes__" are reserved for these markers.
+    """
+    blobs = []
+
+    def replace_bytes(o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            blobs.append(o)
+            return {BYTES_MARKER: len(o)}
+        raise TypeError('%r is not JSON serializable' % o)
+
+    header = bytes(json.dumps(values, default=replace_bytes, separators=(',', ':')), 'utf-8')
+    return b''.join([_PAYLOAD_HEADER.pack(len(header)), header] + blobs)
+
+
+def decode_payload(data):
+    """Values of a payload written by encode_payload, bytes objects are restored"""
+    header_length, = _PAYLOAD_HEADER.unpack_from(data)
+    offset = _PAYLOAD_HEADER.size + header_length
+
+    def restore_bytes(d):
+        nonlocal offset
+        if len(d) == 1 and BYTES_MARKER in d:
+            # markers are completed in the order their bytes were appended
+            blob = bytes(data[offset:offset + d[BYTES_MARKER]])
+            offset = offset + d[BYTES_MARKER]
+            return blob
+        return d
+
+    header = data[_PAYLOAD_HEADER.size:_PAYLOAD_HEADER.size + header_length]
+    return json.loads(bytes(header).decode('utf-8'), object_hook=restore_bytes)
+
+
+def pack_request(request, request_hash):
+    """Data of a RequestMessage"""
+    return encode_payload({'request': request, 'request_hash': request_hash})
+
+
+def pack_response(status, description, request_hash):
+    """Data of a ResponseMessage"""
+    return encode_payload({'status': status, 'description': description, 'request_hash': request_hash})
+
+
+def hash_request(client_addr, request):
+    """Hash identifying the request of a client"""
+    return mmh3.hash(encode_payload([client_addr, list(request)]))
+
 
 class Message:
     """ basic class of message
@@ -119,7 +177,7 @@ class RegistrationMessage(Message):
 class RequestMessage(Message):
     def __init__(self, data, source_addr=None):
         super(RequestMessage, self).__init__(MESSAGE_CODE_REQUEST, data, source_addr)
-        raw = json.loads(data.decode())
+        raw = decode_payload(data)
         self.request = tuple(raw['request'])
         self.request_hash = raw['request_hash']
 
@@ -134,7 +192,7 @@ class RequestMessage(Message):
 class ResponseMessage(Message):
     def __init__(self, data, source_addr=None):
         super(ResponseMessage, self).__init__(MESSAGE_CODE_RESPONSE, data, source_addr)
-        raw = json.loads(data.decode())
+        raw = decode_payload(data)
         self.status = raw['status']
         self.description = raw['description']
         self.request_hash = raw['request_hash']
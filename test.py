@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 from test import test_gossip_receive, test_gossip_send, test_gossip_connection, test_gossip_notification, \
-    test_conn_node, test_data_storage
+    test_conn_node, test_data_storage, test_sstable, test_commit_log, test_message, test_ring_snapshot, \
+    test_group_commit, benchmark_storage, benchmark_engine, benchmark_partitioner
 
 DEFAULT_CONFIG_PATH = "config/config.ini"
 DEFAULT_TEST = "send"
@@ -26,3 +27,19 @@ if __name__ == '__main__':
         test_conn_node.main(config_path)
     elif test_name == 'storage':
         test_data_storage.main()
+    elif test_name == 'sstable':
+        test_sstable.main()
+    elif test_name == 'commit_log':
+        test_commit_log.main()
+    elif test_name == 'message':
+        test_message.main()
+    elif test_name == 'ring_snapshot':
+        test_ring_snapshot.main()
+    elif test_name == 'group_commit':
+        test_group_commit.main()
+    elif test_name == 'benchmark_storage':
+        benchmark_storage.main()
+    elif test_name == 'benchmark_engine':
+        benchmark_engine.main(config_path)
+    elif test_name == 'benchmark_partitioner':
+        benchmark_partitioner.main()
@@ -0,0 +1,277 @@
+"""In-process benchmark of the storage engine: DataStorage is driven directly, without node, queues or sockets.
+
+Every workload runs on a fresh data directory with the background compaction and flush threads of the engine, and
+reports throughput, latency percentiles, the SSTable count and the bytes on disk as JSON.
+
+    python test.py -t benchmark_engine [-c config]
+    python -m test.benchmark_engine [-c config] [-w workload ...] [-r rows] [-n ops] [-l value_length] [-o output]
+
+With -s shard counts, puts and gets of the rows are sent instead through the queues of a node (its controller and the
+storage shards of create_storage, without sockets) for every number of shards, and their throughput is reported.
+
+    python -m test.benchmark_engine -s 1 2 4 [-c config] [-r rows] [-n ops] [-l value_length] [-o output]
+
+The engine is configured by the [STORAGER] section of the configuration file (its datafile_dir is replaced).
+"""
+import json
+import os
+import random
+import shutil
+import time
+from argparse import ArgumentParser
+from configparser import RawConfigParser
+
+from cassandra.conn.node import Node
+from cassandra.engine.dispatcher import create_storage
+from cassandra.engine.storage import DataStorage
+from cassandra.util.message import RequestMessage, pack_request
+from cassandra.util.queue_item_types import QUEUE_ITEM_TYPE_RECEIVED_MESSAGE
+
+DEFAULT_CONFIG_PATH = 'config/config.ini'
+DATAFILE_DIR = 'data/benchmark_engine/'
+ZIPFIAN_CONSTANT = 0.99
+# requests sent to the node without their response yet in the shard benchmark
+SHARD_BENCHMARK_WINDOW = 256
+CLIENT_ADDR = ('127.0.0.1', 9000)
+
+
+class ZipfianGenerator:
+    """Zipfian distributed integers in [0, n), 0 the most popular (Gray et al., "Quickly generating billion-record
+    synthetic databases", as in YCSB). Ranks are mapped to items through a random permutation, so the popular items
+    are spread over the key space."""
+
+    def __init__(self, n, theta=ZIPFIAN_CONSTANT, seed=0):
+        self.n = n
+        self.theta = theta
+        self.random = random.Random(seed)
+        zeta_2 = 1 + 0.5 ** theta
+        self.zeta_n = sum(1 / (i ** theta) for i in range(1, n + 1))
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / n) ** (1 - theta)) / (1 - zeta_2 / self.zeta_n)
+        self.items = list(range(n))
+        self.random.shuffle(self.items)
+
+    def next(self):
+        u = self.random.random()
+        uz = u * self.zeta_n
+        if uz < 1:
+            rank = 0
+        elif uz < 1 + 0.5 ** self.theta:
+            rank = 1
+        else:
+            rank = min(int(self.n * (self.eta * u - self.eta + 1) ** self.alpha), self.n - 1)
+        return self.items[rank]
+
+
+def make_key(i):
+    return '%012d' % i
+
+
+def disk_usage(path):
+    size = 0
+    for directory, _, files in os.walk(path):
+        size = size + sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+    return size
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def sequential_put(rows, ops, rand):
+    return [('put', i % rows) for i in range(ops)]
+
+
+def random_put(rows, ops, rand):
+    return [('put', rand.randrange(rows)) for _ in range(ops)]
+
+
+def sequential_get(rows, ops, rand):
+    return [('get', i % rows) for i in range(ops)]
+
+
+def random_get(rows, ops, rand):
+    return [('get', rand.randrange(rows)) for _ in range(ops)]
+
+
+def overwrite(rows, ops, rand):
+    # every put hits one of the 1% hottest keys, the other keys are only loaded
+    hot = max(rows // 100, 1)
+    return [('put', rand.randrange(hot)) for _ in range(ops)]
+
+
+def zipfian_get(rows, ops, rand):
+    zipf = ZipfianGenerator(rows, seed=rand.random())
+    return [('get', zipf.next()) for _ in range(ops)]
+
+
+def zipfian_update(rows, ops, rand):
+    # half reads, half writes of Zipfian keys (YCSB workload A)
+    zipf = ZipfianGenerator(rows, seed=rand.random())
+    return [('get' if rand.random() < 0.5 else 'put', zipf.next()) for _ in range(ops)]
+
+
+# workload: (operations generator, whether the rows are loaded before the measured operations)
+WORKLOADS = {
+    'sequential_put': (sequential_put, False),
+    'random_put': (random_put, False),
+    'sequential_get': (sequential_get, True),
+    'random_get': (random_get, True),
+    'overwrite': (overwrite, True),
+    'zipfian_get': (zipfian_get, True),
+    'zipfian_update': (zipfian_update, True),
+}
+
+
+def run_workload(name, config, rows, ops, value_length, seed=0):
+    """Run one workload on a fresh data directory, returns its results"""
+    generate, preload = WORKLOADS[name]
+    rand = random.Random(seed)
+    datafile_dir = os.path.join(DATAFILE_DIR, name)
+    shutil.rmtree(datafile_dir, ignore_errors=True)
+    config = dict(config, datafile_dir=datafile_dir)
+    config.pop('commit_log_dir', None)
+
+    ds = DataStorage(None, config)
+    ds.start_background_tasks()
+    try:
+        if preload:
+            for i in range(rows):
+                ds.put(make_key(i), os.urandom(value_length))
+            ds.flush_to_file()
+            ds.release_obsolete_sstables()
+
+        operations = [(op, make_key(i)) for op, i in generate(rows, ops, rand)]
+        latencies = []
+        misses = 0
+        start = time.perf_counter()
+        for op, key in operations:
+            op_start = time.perf_counter()
+            if op == 'put':
+                status, _ = ds.put(key, os.urandom(value_length))
+            else:
+                status, data = ds.get(key)
+                misses = misses + (1 if status and not data else 0)
+            latencies.append(time.perf_counter() - op_start)
+            if not status:
+                raise Exception('%s of %s failed' % (op, key))
+            ds.release_obsolete_sstables()
+        elapsed = time.perf_counter() - start
+    finally:
+        ds.stop_background_tasks()
+    ds.release_obsolete_sstables()
+
+    latencies.sort()
+    stats = ds.get_stats()
+    return {
+        'workload': name,
+        'rows': rows,
+        'ops': ops,
+        'value_length': value_length,
+        'seconds': elapsed,
+        'throughput': ops / elapsed if elapsed else 0,
+        'latency_us': {
+            'p50': percentile(latencies, 50) * 1e6,
+            'p99': percentile(latencies, 99) * 1e6,
+            'max': latencies[-1] * 1e6 if latencies else 0,
+        },
+        'get_misses': misses,
+        'sstables': stats['sstables'],
+        'memtable_entries': stats['memtable']['entries'],
+        'disk_bytes': disk_usage(datafile_dir),
+        'read_amplification': stats['read_amplification']['average'],
+    }
+
+
+def send_requests(node, requests, window=SHARD_BENCHMARK_WINDOW):
+    """Pass requests to the controller of node as if received from a client, at most window of them waiting for their
+    response, returns the seconds until all responses were sent"""
+    start = time.perf_counter()
+    sent = 0
+    received = 0
+    while received < len(requests):
+        while sent < len(requests) and sent - received < window:
+            message = RequestMessage(pack_request(requests[sent], sent), CLIENT_ADDR)
+            node.receiver_queue.put({'type': QUEUE_ITEM_TYPE_RECEIVED_MESSAGE, 'identifier': None, 'message': message})
+            sent = sent + 1
+        response = node.sender_queue.get()['message']
+        if not response.status:
+            raise Exception('request %d failed: %s' % (response.request_hash, response.description))
+        received = received + 1
+    return time.perf_counter() - start
+
+
+def run_shards(shard_num, config, rows, ops, value_length):
+    """Put ops rows, then get ops of them, through the queues of a node with shard_num storage shards, returns the
+    throughput of both"""
+    datafile_dir = os.path.join(DATAFILE_DIR, 'shards-%d' % shard_num)
+    shutil.rmtree(datafile_dir, ignore_errors=True)
+    config = dict(config, datafile_dir=datafile_dir, storage_shards=str(shard_num))
+    config.pop('commit_log_dir', None)
+
+    node = Node({'listen_addr': '127.0.0.1:7000', 'seeds': ''})
+    storage = create_storage(node, config)
+    processes = [node.controller, storage] + getattr(storage, 'shards', [])
+    node.controller.start()
+    storage.start()
+    try:
+        value = os.urandom(value_length)
+        puts = [('put', make_key(i % rows), value) for i in range(ops)]
+        put_time = send_requests(node, puts)
+        gets = [('get', make_key(i % rows)) for i in range(ops)]
+        get_time = send_requests(node, gets)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        node.connection_pool.manager.shutdown()
+    shutil.rmtree(datafile_dir, ignore_errors=True)
+
+    return {
+        'shards': shard_num,
+        'rows': rows,
+        'ops': ops,
+        'value_length': value_length,
+        'put_throughput': ops / put_time if put_time else 0,
+        'get_throughput': ops / get_time if get_time else 0,
+    }
+
+
+def main(config_path=DEFAULT_CONFIG_PATH, workloads=None, rows=100000, ops=100000, value_length=100, output=None,
+         shard_counts=None):
+    config_parser = RawConfigParser()
+    config_parser.read(config_path)
+    config = dict(config_parser['STORAGER']) if config_parser.has_section('STORAGER') else {}
+
+    results = []
+    if shard_counts:
+        for shard_num in shard_counts:
+            results.append(run_shards(shard_num, config, rows, ops, value_length))
+            print(json.dumps(results[-1], sort_keys=True))
+    else:
+        for name in workloads or sorted(WORKLOADS):
+            results.append(run_workload(name, config, rows, ops, value_length))
+            print(json.dumps(results[-1], sort_keys=True))
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', help='Configuration file path', default=DEFAULT_CONFIG_PATH)
+    parser.add_argument('-w', '--workload', help='workloads to run (default: all)', nargs='+',
+                        choices=sorted(WORKLOADS))
+    parser.add_argument('-r', '--rows', help='number of distinct keys', type=int, default=100000)
+    parser.add_argument('-n', '--ops', help='operations per workload', type=int, default=100000)
+    parser.add_argument('-l', '--value-length', help='bytes per value', type=int, default=100)
+    parser.add_argument('-o', '--output', help='write the results of all workloads to this JSON file')
+    parser.add_argument('-s', '--shards', help='compare these numbers of storage shards instead of running workloads',
+                        type=int, nargs='+')
+    args = parser.parse_args()
+    main(args.config, args.workload, args.rows, args.ops, args.value_length, args.output, args.shards)
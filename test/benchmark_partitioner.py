@@ -0,0 +1,70 @@
+import random
+import string
+import time
+
+from cassandra.partitioner.ring_partitioner import RingPartitioner
+
+
+def random_str(length):
+    selection = string.ascii_letters + string.digits
+    return ''.join([random.choice(selection) for _ in range(length)])
+
+
+def build_ring(vnodes, physical_nodes=10, replica_num=3):
+    """RingPartitioner without node holding physical_nodes nodes of vnodes / physical_nodes virtual nodes each"""
+    partitioner = RingPartitioner(None, {'v_node_num': str(vnodes // physical_nodes), 'replica_num': str(replica_num)})
+    for i in range(physical_nodes):
+        partitioner.new_physical_node('10.0.0.%d:7000' % (i + 1))
+    return partitioner
+
+
+def bench_get_node_addrs(vnode_counts=(1000, 10000, 100000), lookups=100000):
+    """Routing throughput of get_node_addrs on rings of different sizes"""
+    keys = [random_str(10) for _ in range(lookups)]
+    for vnodes in vnode_counts:
+        start = time.perf_counter()
+        partitioner = build_ring(vnodes)
+        build_time = time.perf_counter() - start
+
+        # what a process routing on an older ring does once per ring change: load the current snapshot
+        partitioner.snapshot.version = 0
+        start = time.perf_counter()
+        partitioner.refresh_ring()
+        swap_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for key in keys:
+            partitioner.get_node_addrs(key)
+        elapsed = time.perf_counter() - start
+        print('vnodes=%-6d  ring built in %6.2fs  snapshot loaded in %7.2fms  %d lookups: %.3fs (%.2f us/lookup)'
+              % (len(partitioner.tokens), build_time, swap_time * 1e3, lookups, elapsed, elapsed / lookups * 1e6))
+        partitioner.close()
+        partitioner.manager.shutdown()
+
+
+def bench_get_node_addrs_many(vnodes=10000, key_counts=(1000, 100000)):
+    """Bulk routing with get_node_addrs_many against get_node_addrs key by key"""
+    partitioner = build_ring(vnodes)
+    for count in key_counts:
+        keys = [random_str(10) for _ in range(count)]
+
+        start = time.perf_counter()
+        groups = {}
+        for key in keys:
+            groups.setdefault(tuple(sorted(partitioner.get_node_addrs(key))), []).append(key)
+        one_by_one = time.perf_counter() - start
+
+        start = time.perf_counter()
+        groups_many = partitioner.get_node_addrs_many(keys)
+        many = time.perf_counter() - start
+
+        assert groups == groups_many
+        print('vnodes=%-6d  %6d keys in %3d replica sets  get_node_addrs: %.3fs  get_node_addrs_many: %.3fs (%.1fx)'
+              % (vnodes, count, len(groups), one_by_one, many, one_by_one / many))
+    partitioner.close()
+    partitioner.manager.shutdown()
+
+
+def main():
+    bench_get_node_addrs()
+    bench_get_node_addrs_many()
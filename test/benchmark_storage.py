@@ -0,0 +1,215 @@
+import os
+import random
+import shutil
+import string
+import time
+import tracemalloc
+
+from cassandra.engine.memtable import MEMTABLE_TYPES
+from cassandra.engine.storage import DataStorage
+
+DATAFILE_DIR = 'data/benchmark/'
+
+
+def random_str(length):
+    selection = string.ascii_letters + string.digits
+    return ''.join([random.choice(selection) for _ in range(length)])
+
+
+def lineitem_str(i):
+    """A CSV row shaped like a TPC-H lineitem"""
+    return '%d|%d|%d|%d|%d|%.2f|%.2f|%.2f|%s|%s|1996-%02d-%02d|1996-%02d-%02d|%s|%s|%s' % (
+        i // 4, random.randint(1, 200000), random.randint(1, 10000), i % 4 + 1, random.randint(1, 50),
+        random.uniform(900, 100000), random.choice([0.0, 0.01, 0.02, 0.05, 0.1]), random.choice([0.0, 0.02, 0.08]),
+        random.choice('NRA'), random.choice('OF'), random.randint(1, 12), random.randint(1, 28),
+        random.randint(1, 12), random.randint(1, 28), random.choice(['DELIVER IN PERSON', 'COLLECT COD', 'NONE']),
+        random.choice(['TRUCK', 'MAIL', 'SHIP', 'AIR', 'RAIL']), 'carefully final deposits ' + random_str(8))
+
+
+def load(config, rows, value_length, value=None):
+    """Create a data directory with rows random rows, returns the keys"""
+    shutil.rmtree(config['datafile_dir'], ignore_errors=True)
+    ds = DataStorage(None, config)
+    keys = []
+    for i in range(rows):
+        key = '%010d' % i
+        ds.put(key, bytes(value(i) if value is not None else random_str(value_length), 'ascii'))
+        keys.append(key)
+    ds.flush_to_file()
+    return keys
+
+
+def data_size(datafile_dir):
+    return sum(os.path.getsize(os.path.join(datafile_dir, f))
+               for f in os.listdir(datafile_dir) if f.endswith(DataStorage.DATA_FILE_EXT))
+
+
+def time_gets(ds, keys):
+    start = time.perf_counter()
+    for key in keys:
+        ds.get(key)
+    return time.perf_counter() - start
+
+
+def bench_mmap(rows=100000, value_length=100, gets=10000):
+    """Compare memory-mapped reads against open/seek/read on random gets of existing keys"""
+    config = {
+        'datafile_dir': DATAFILE_DIR,
+        'max_indices_in_memory': -1,
+        'max_data_per_sstable': 2 ** 20,
+    }
+    keys = load(config, rows, value_length)
+    sample = [random.choice(keys) for _ in range(gets)]
+
+    for mmap_data_files in ['false', 'true']:
+        ds = DataStorage(None, dict(config, mmap_data_files=mmap_data_files))
+        time_gets(ds, sample)  # warm up index and mapping caches
+        elapsed = time_gets(ds, sample)
+        print('mmap_data_files=%-5s  %d gets over %d sstables: %.3fs (%.1f us/get)'
+              % (mmap_data_files, gets, len(ds.table_index_names), elapsed, elapsed / gets * 1e6))
+
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+
+def bench_compression(rows=100000, gets=10000, block_sizes=(4096, 16384, 65536)):
+    """Compare plain and zlib block-compressed data files: write and read throughput, size on disk"""
+    config = {
+        'datafile_dir': DATAFILE_DIR,
+        'max_indices_in_memory': -1,
+        'max_data_per_sstable': 2 ** 22,
+    }
+    for compression, block_size in [('none', 0)] + [('zlib', b) for b in block_sizes]:
+        c = dict(config, compression=compression, compression_block_size=block_size)
+        random.seed(0)
+        start = time.perf_counter()
+        keys = load(c, rows, 0, lineitem_str)
+        load_time = time.perf_counter() - start
+
+        ds = DataStorage(None, c)
+        sample = [random.choice(keys) for _ in range(gets)]
+        elapsed = time_gets(ds, sample)
+        start = time.perf_counter()
+        page_token = ''
+        while page_token is not None:
+            _, page = ds.scan(page_token)
+            page_token = page['page_token']
+        scan_time = time.perf_counter() - start
+        print('compression=%-4s block=%-6d  data files %6.2f MB  load %6.0f rows/s  random get %6.0f gets/s  '
+              'scan %7.0f rows/s' % (compression, block_size, data_size(DATAFILE_DIR) / 2 ** 20, rows / load_time,
+                                      gets / elapsed, rows / scan_time))
+
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+
+def bench_batch(rows=50000, batch_sizes=(1, 16, 64, 256), commit_log_sync='periodic'):
+    """Throughput of puts and gets handled through handle_requests in batches of different sizes"""
+    config = {
+        'datafile_dir': DATAFILE_DIR,
+        'max_data_per_sstable': 2 ** 20,
+        'commit_log_sync': commit_log_sync,
+    }
+    for batch_size in batch_sizes:
+        shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+        ds = DataStorage(None, config)
+        puts = [['put', '%010d' % random.randrange(rows), bytes(random_str(100), 'ascii')] for _ in range(rows)]
+        gets = [['get', request[1]] for request in puts]
+        times = []
+        for requests in [puts, gets]:
+            start = time.perf_counter()
+            for i in range(0, len(requests), batch_size):
+                ds.handle_requests(requests[i:i + batch_size])
+            times.append(time.perf_counter() - start)
+        print('commit_log_sync=%-8s batch=%-4d  put %7.0f rows/s  get %7.0f rows/s'
+              % (commit_log_sync, batch_size, rows / times[0], rows / times[1]))
+
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+
+def fill_memtable(memtable, numbers, prefix):
+    for version, i in enumerate(numbers):
+        key = '%010d' % i
+        memtable.put(key, prefix + bytes(key, 'ascii'), version)
+
+
+def bench_memtable_memory(rows=1000000, value_length=100, gets=100000):
+    """Memory per row (traced with tracemalloc) and put/get throughput of each memtable type holding rows rows"""
+    numbers = list(range(rows))
+    random.shuffle(numbers)
+    prefix = bytes(random_str(value_length - 10), 'ascii')
+    sample = ['%010d' % random.randrange(rows) for _ in range(gets)]
+    for memtable_type, memtable_class in sorted(MEMTABLE_TYPES.items()):
+        tracemalloc.start()
+        memtable = memtable_class()
+        fill_memtable(memtable, numbers, prefix)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        accounted = memtable.size
+        del memtable
+
+        memtable = memtable_class()
+        start = time.perf_counter()
+        fill_memtable(memtable, numbers, prefix)
+        put_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for key in sample:
+            memtable.get(key)
+        get_time = time.perf_counter() - start
+        print('memtable_type=%-6s  %d rows: %7.1f MB, %5.1f bytes/row (%.0f data bytes/row, accounted %5.1f)  '
+              'put %7.0f rows/s  get %7.0f rows/s'
+              % (memtable_type, rows, memory / 2 ** 20, memory / rows, memtable.data_size / rows, accounted / rows,
+                 rows / put_time, gets / get_time))
+        del memtable
+
+
+def bench_key_cache(rows=100000, value_length=100, gets=20000, hot_keys=1000):
+    """Gets of hot keys spread over many SSTables, with and without key cache"""
+    config = {
+        'datafile_dir': DATAFILE_DIR,
+        'max_indices_in_memory': -1,
+        'max_data_per_sstable': 2 ** 19,
+    }
+    keys = load(config, rows, value_length)
+    sample = [random.choice(keys[:hot_keys]) for _ in range(gets)]
+
+    for key_cache_size in [0, hot_keys]:
+        ds = DataStorage(None, dict(config, key_cache_size=key_cache_size))
+        time_gets(ds, sample)  # warm up index and key caches
+        ds.read_amplification_stats = {'reads': 0, 'sstables': 0}
+        ds.bloom_filter_stats = {'hits': 0, 'misses': 0, 'false_positives': 0}
+        elapsed = time_gets(ds, sample)
+        stats = ds.get_stats()
+        print('key_cache_size=%-6d  %d gets over %d sstables: %.3fs (%.1f us/get), %.2f sstables/get, bloom filter '
+              'checks %d' % (key_cache_size, gets, stats['sstables'], elapsed, elapsed / gets * 1e6,
+                             stats['read_amplification']['average'],
+                             stats['bloom_filter']['hits'] + stats['bloom_filter']['misses']))
+
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+
+def bench_index_summary(rows=200000, value_length=20, gets=20000, intervals=(16, 128, 1024)):
+    """Index summary memory and random get throughput for several index_summary_interval values"""
+    config = {
+        'datafile_dir': DATAFILE_DIR,
+        'max_data_per_sstable': 2 ** 22,
+    }
+    keys = load(config, rows, value_length)
+    sample = [random.choice(keys) for _ in range(gets)]
+
+    for interval in intervals:
+        ds = DataStorage(None, dict(config, index_summary_interval=interval))
+        time_gets(ds, sample)  # build the summaries
+        elapsed = time_gets(ds, sample)
+        stats = ds.get_stats()['index_summary']
+        print('index_summary_interval=%-5d  %d entries: %6d samples, %8.1f KB summary  random get %6.0f gets/s'
+              % (interval, stats['entries'], stats['samples'], stats['memory'] / 2 ** 10, gets / elapsed))
+
+    shutil.rmtree(DATAFILE_DIR, ignore_errors=True)
+
+
+def main():
+    bench_mmap()
+    bench_compression()
+    bench_batch()
+    bench_memtable_memory()
+    bench_key_cache()
+    bench_index_summary()
@@ -1,6 +1,7 @@
 from cassandra.engine.storage import DataStorage
 
 import random
+import shutil
 import string
 
 
@@ -15,22 +16,36 @@ def main():
         'max_indices_in_memory': 10,
         'max_data_per_sstable': 1000  # 10M
     }
-    ds = DataStorage(**config)
+    shutil.rmtree(config['datafile_dir'], ignore_errors=True)
+    ds = DataStorage(None, config)
 
     # put test
-    keys = set()
+    expected = {}
     for i in range(1000):
         key = random_str(2)
-        data = random_str(10)
-        keys.add(key)
-        ds.put(key, data)
+        data = bytes(random_str(10), 'ascii')
+        expected[key] = data
+        assert ds.put(key, data)[0]
 
     # get test
-    keys = list(keys)
+    keys = list(expected)
     for i in range(20):
         key = random.choice(keys)
-        print(key + " - " + str(ds.get(key)))
+        status, row = ds.get(key)
+        assert status and row[0] == expected[key], (key, row, expected[key])
+        print(key + " - " + str(row))
 
     for i in range(20):
         key = random_str(2)
-        print(key + " - " + str(ds.get(key)))
+        status, row = ds.get(key)
+        assert status and (row[0] if row else None) == expected.get(key), (key, row)
+        print(key + " - " + str(row))
+
+    # reopening replays the commit log and loads the SSTables
+    ds.flush_to_file()
+    ds = DataStorage(None, config)
+    for key in keys:
+        assert ds.get(key)[1][0] == expected[key], key
+    print('%d keys ok' % len(keys))
+
+    shutil.rmtree(config['datafile_dir'], ignore_errors=True)
@@ -0,0 +1,52 @@
+from cassandra.conn.node import Node
+from cassandra.engine.storage import DataStorage
+from cassandra.util.message import RequestMessage, pack_request
+from cassandra.util.queue_item_types import QUEUE_ITEM_TYPE_RECEIVED_MESSAGE
+
+import shutil
+from queue import Empty
+
+CLIENT_ADDR = ('127.0.0.1', 9000)
+
+
+def request(node, req, request_hash, timeout=2):
+    """Pass req to the controller of node as if received from a client, returns its response or None after timeout
+    seconds"""
+    message = RequestMessage(pack_request(req, request_hash), CLIENT_ADDR)
+    node.receiver_queue.put({'type': QUEUE_ITEM_TYPE_RECEIVED_MESSAGE, 'identifier': None, 'message': message})
+    try:
+        return node.sender_queue.get(timeout=timeout)['message']
+    except Empty:
+        return None
+
+
+def test_group_commit(config, puts=3):
+    """Every put of group commit mode is acknowledged within the group window, also when it freezes the memtable
+    (and so syncs the commit log) on its own"""
+    shutil.rmtree(config['datafile_dir'], ignore_errors=True)
+    node = Node({'listen_addr': '127.0.0.1:7000', 'seeds': ''})
+    storage = DataStorage(node, config)
+    node.controller.start()
+    storage.start()
+    try:
+        for i in range(puts):
+            response = request(node, ('put', 'key%d' % i, b'value'), i)
+            assert response is not None, 'put %d of %s not acknowledged' % (i, config)
+            assert response.status and response.request_hash == i, response.description
+        response = request(node, ('get', 'key0'), puts)
+        assert response is not None and response.description[0] == b'value', response
+    finally:
+        for process in (storage, node.controller):
+            process.terminate()
+            process.join()
+        node.connection_pool.manager.shutdown()
+    shutil.rmtree(config['datafile_dir'], ignore_errors=True)
+
+
+def main():
+    config = {'datafile_dir': 'data/test_group_commit/', 'commit_log_sync': 'group', 'commit_log_group_window': '10'}
+    test_group_commit(config)
+    print('group commit ok')
+    # every put exceeds the budget and freezes the memtable
+    test_group_commit(dict(config, memtable_memory_budget='1'))
+    print('group commit over the memtable memory budget ok')
@@ -0,0 +1,48 @@
+from cassandra.util.message import encode_payload, decode_payload, pack_request, pack_response, RequestMessage, \
+    ResponseMessage
+
+import random
+
+
+def random_bytes(length):
+    return bytes(random.getrandbits(8) for _ in range(length))
+
+
+def test_payload():
+    """Values with bytes anywhere in them come back unchanged, bytes are neither transcoded nor escaped"""
+    values = [
+        b'',
+        b'plain ascii',
+        random_bytes(1000),
+        b'\x00\xff{"__bytes__": 3}\n\\',
+        ['put', 'key', random_bytes(10)],
+        {'request': ['get', 'k'], 'nested': {'a': [b'x', 1, None, b'yz']}, 'text': 'été'},
+        [b'a', [b'b', [b'c']], {'k': b'd'}, b'e'],
+        {'__bytes__': 1, 'other': b'f'},
+        [],
+        None,
+    ]
+    for value in values:
+        data = encode_payload(value)
+        assert decode_payload(data) == value, value
+        # payloads are decoded from memoryviews of received buffers too
+        assert decode_payload(memoryview(data)) == value, value
+    # a large value is appended raw, the payload grows by the header only
+    value = random_bytes(1 << 20)
+    assert len(encode_payload(['put', 'k', value])) < len(value) + 64
+    print('payload ok')
+
+
+def test_messages():
+    """Requests and responses carry their values as bytes"""
+    value = random_bytes(100)
+    request = RequestMessage(pack_request(('put', 'key', value), 42), ('127.0.0.1', 7000))
+    assert request.request == ('put', 'key', value) and request.request_hash == 42
+    response = ResponseMessage(pack_response(True, [value, 3], 42), ('127.0.0.1', 7000))
+    assert response.status is True and response.description == [value, 3] and response.request_hash == 42
+    print('messages ok')
+
+
+def main():
+    test_payload()
+    test_messages()
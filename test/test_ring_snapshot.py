@@ -0,0 +1,86 @@
+from cassandra.partitioner.ring_partitioner import RingPartitioner
+from cassandra.partitioner.ring_snapshot import RingSnapshot, walk_replicas
+
+import random
+
+
+def check_replicas(owner_ids, replica_num):
+    """Every row of the replica table holds distinct physical nodes, the first ones met walking the ring"""
+    replica_ids, width = walk_replicas(owner_ids, replica_num)
+    assert width == min(replica_num, len(set(owner_ids)))
+    assert len(replica_ids) == len(owner_ids) * width
+    for pos in range(0, len(owner_ids)):
+        row = list(replica_ids[pos * width:(pos + 1) * width])
+        assert len(set(row)) == width, (owner_ids, pos, row)
+        expected = []
+        for owner in owner_ids[pos:] + owner_ids[:pos]:
+            if len(expected) < width and owner not in expected:
+                expected.append(owner)
+        assert row == expected, (owner_ids, pos, row, expected)
+
+
+def test_walk_replicas():
+    # vnodes of the same physical node next to each other on the ring
+    check_replicas([0, 0, 0, 1, 1, 2], 3)
+    check_replicas([0, 0, 1, 1, 2, 2, 0, 0], 2)
+    check_replicas([0, 1, 1, 1, 1, 0], 2)
+    # fewer physical nodes than replicas: every node stores every key
+    check_replicas([0, 0, 1, 1], 3)
+    check_replicas([0, 0, 0], 3)
+    for _ in range(200):
+        nodes = random.randint(1, 6)
+        owner_ids = [random.randrange(nodes) for _ in range(random.randint(1, 40))]
+        check_replicas(owner_ids, random.randint(1, 4))
+
+    owners = ['a', 'a', 'b', 'b', 'a', 'c']
+    snapshot = RingSnapshot.from_ring(1, list(range(len(owners))), owners, 2)
+    assert snapshot.replicas == [('a', 'b'), ('a', 'b'), ('a', 'b'), ('a', 'b'), ('a', 'c'), ('a', 'c')]
+    decoded = RingSnapshot.decode(snapshot.encode())
+    assert decoded.replicas == snapshot.replicas and decoded.owners == owners
+    print('walk_replicas ok')
+
+
+def ring_of(partitioner):
+    snapshot = partitioner.snapshot
+    return list(snapshot.tokens), snapshot.owners, snapshot.replicas
+
+
+def test_balanced_join_order():
+    """Partitioners learning the same members in different orders build the same balanced ring"""
+    config = {'v_node_num': '4', 'replica_num': '3', 'token_allocation': 'balanced'}
+    nodes = ['10.0.0.%d:7000' % i for i in range(1, 7)]
+    partitioners = [RingPartitioner(None, config) for _ in range(3)]
+    orders = [list(nodes), list(reversed(nodes)), random.sample(nodes, len(nodes))]
+    try:
+        for partitioner, order in zip(partitioners, orders):
+            for phy_id in order:
+                partitioner.new_physical_node(phy_id)
+        rings = [ring_of(partitioner) for partitioner in partitioners]
+        assert len(rings[0][0]) == len(nodes) * 4
+        assert all(ring == rings[0] for ring in rings), orders
+
+        # leaving and rejoining in different orders
+        partitioners[0].delete_physical_node(nodes[2])
+        partitioners[0].delete_physical_node(nodes[4])
+        partitioners[1].delete_physical_node(nodes[4])
+        partitioners[1].delete_physical_node(nodes[2])
+        assert ring_of(partitioners[0]) == ring_of(partitioners[1])
+        partitioners[0].new_physical_node(nodes[4])
+        partitioners[1].new_physical_node(nodes[4])
+        assert ring_of(partitioners[0]) == ring_of(partitioners[1])
+
+        # a node whose id sorts last joining keeps the tokens of all the others
+        before = dict(partitioners[2].node2token)
+        partitioners[2].new_physical_node('10.0.0.9:7000')
+        after = dict(partitioners[2].node2token)
+        assert all(after[v_id] == token for v_id, token in before.items())
+    finally:
+        for partitioner in partitioners:
+            partitioner.close()
+            partitioner.manager.shutdown()
+    print('balanced join order ok')
+
+
+def main():
+    test_walk_replicas()
+    test_balanced_join_order()
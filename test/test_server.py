@@ -6,7 +6,7 @@ import os
 from argparse import ArgumentParser
 
 from cassandra.conn.node import Node
-from cassandra.engine.storage import DataStorage
+from cassandra.engine.dispatcher import create_storage
 from cassandra.gossip.gossiper import Gossiper
 from cassandra.partitioner.ring_partitioner import RingPartitioner
 from cassandra.server.server import CassandraServer
@@ -39,7 +39,7 @@ def main():
 
     gossiper = Gossiper(node)
     partitioner = RingPartitioner(node, dict(config_parser['PARTITIONER']))
-    storager = DataStorage(node, dict(config_parser['STORAGER']))
+    storager = create_storage(node, dict(config_parser['STORAGER']))
 
     server = CassandraServer(node, partitioner, dict(config_parser['SERVER']))
 
@@ -0,0 +1,74 @@
+from cassandra.engine.bloom_filter import BloomFilter
+from cassandra.engine.sstable import IndexReader, write_index
+
+import os
+import random
+import shutil
+import string
+
+
+def random_str(length):
+    selection = string.ascii_letters + string.digits
+    return ''.join([random.choice(selection) for _ in range(length)])
+
+
+def test_index(data_dir):
+    """Lookups through the summary and the on-disk windows of a binary index find every key and no other"""
+    keys = sorted(set(random_str(random.randint(1, 12)) for _ in range(2000)))
+    entries = [(key, i * 100, i % 50, i) for i, key in enumerate(keys)]
+    index_file_path = os.path.join(data_dir, 'test.ssbi')
+    write_index(index_file_path, entries)
+
+    for summary_interval in (1, 3, 128, 5000):
+        index = IndexReader(index_file_path, summary_interval)
+        assert len(index) == len(keys)
+        for key, offset, length, version in entries:
+            assert index.search(key) == [offset, length, version], (summary_interval, key)
+        # keys before, between and after the indexed ones
+        key_set = set(keys)
+        for key in ['', '~'] + [random_str(random.randint(1, 12)) for _ in range(500)]:
+            if key not in key_set:
+                assert index.search(key) is None, (summary_interval, key)
+        # a summary built once is reused when the index is reopened
+        reopened = IndexReader(index_file_path, summary_interval, index.summary)
+        assert reopened.search(keys[-1]) == list(entries[-1][1:])
+        assert list(reopened.iter_from(keys[10], keys[20])) == entries[10:20]
+        assert list(reopened) == entries
+        index.close()
+        reopened.close()
+
+    empty_file_path = os.path.join(data_dir, 'empty.ssbi')
+    write_index(empty_file_path, [])
+    empty = IndexReader(empty_file_path)
+    assert len(empty) == 0 and empty.search('a') is None
+    empty.close()
+    print('index: %d keys ok' % len(keys))
+
+
+def test_bloom_filter(data_dir):
+    """A bloom filter contains every key added to it, also once written and read back, and rejects most others"""
+    for capacity, fp_chance in ((1, 0.01), (1000, 0.01), (10000, 0.1)):
+        keys = set(random_str(10) for _ in range(capacity))
+        bloom_filter = BloomFilter.for_capacity(len(keys), fp_chance)
+        for key in keys:
+            bloom_filter.add(key)
+        bloom_filter_file_path = os.path.join(data_dir, 'test.ssbf')
+        bloom_filter.write(bloom_filter_file_path)
+        read_back = BloomFilter.read(bloom_filter_file_path)
+        for key in keys:
+            assert bloom_filter.might_contain(key) and key in read_back, (capacity, key)
+
+        if capacity > 1:  # a filter has at least 8 bits, too few for the false positive chance of a single key
+            others = [key for key in (random_str(11) for _ in range(10000)) if key not in keys]
+            false_positives = sum(1 for key in others if key in read_back)
+            assert false_positives <= 2 * fp_chance * len(others) + 10, (capacity, false_positives)
+    print('bloom filter ok')
+
+
+def main():
+    data_dir = 'data/test_sstable/'
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    test_index(data_dir)
+    test_bloom_filter(data_dir)
+    shutil.rmtree(data_dir, ignore_errors=True)